@@ -12,23 +12,186 @@ You need to implement the following functions:
 
 Please handle possible race conditions!
 '''
+from typing import List, Dict, Optional, Tuple
 import logging
 import time
 import random 
+import sys
+import queue
+import threading
+import functools
+import contextlib
+import os
+import sqlite3
+import tempfile
 
-from multiprocessing import Process
+from multiprocessing import Process, Event, Queue
 
 import pymysql
+from pymysql.constants import SERVER_STATUS
 
 
 # The number of web server processes
 NUM_PROCESSES = 3
 
+# Where the coupons are stored: 'mysql' for the MySQL container, or 'sqlite' for a local SQLite file at SQLITE_DB_PATH
+# (in WAL mode, sign-ups take the write lock with BEGIN IMMEDIATE) to run without docker. See COUPON_STORES.
+STORAGE_BACKEND = 'mysql'
+SQLITE_DB_PATH = os.path.join(tempfile.gettempdir(), 'coupons.sqlite3')
+SQLITE_BUSY_TIMEOUT_S = 30
+
 DB_NAME = 'testdb'
 RROMO_TABLE = 'promotions'
 USER_COUPON_TABLE = 'user_coupons'
+PROMO_SHARD_TABLE = 'promotion_shards'
 RPOMO_ID = '123456'
 
+# With NUM_COUPON_SHARDS > 1, the left coupons of a promotion are split across that many rows of PROMO_SHARD_TABLE,
+# so sign-ups lock one of them instead of all waiting for the single promotion row; left_coupons of the promotion
+# row is then NULL.
+NUM_COUPON_SHARDS = 1
+
+# web servers sign up users in batches of SIGN_UP_BATCH_SIZE with users_sign_up_promo(), one transaction per batch;
+# 1 signs up every user with user_sign_up_promo()
+SIGN_UP_BATCH_SIZE = 10
+
+# With REDIS_FRONTED_INVENTORY, the left coupons of the promotion are preloaded into a redis counter, and web
+# servers admit or reject users there (a Lua script decrements the counter only if it is positive), instead of all
+# of them contending on the single promotion row. The admitted users are queued in redis, and one background writer
+# persists them to MySQL in batches; reconcile_redis_inventory() checks the two sides against each other.
+REDIS_FRONTED_INVENTORY = False
+WRITER_BATCH_SIZE = 50
+
+# KEYS[1]: left coupons counter, KEYS[2]: set of admitted users, KEYS[3]: queue of admitted users to persist
+# ARGV[1]: user id; returns 1 when admitted, 0 when there is no coupon left, -1 for a user admitted before
+ADMIT_USER_LUA = '''
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+    return -1
+end
+local left = tonumber(redis.call('GET', KEYS[1]) or '0')
+if left <= 0 then
+    return 0
+end
+redis.call('DECR', KEYS[1])
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('RPUSH', KEYS[3], ARGV[1])
+return 1
+'''
+# the Script object of ADMIT_USER_LUA, registered once on first use
+admit_user_script = None
+
+# Each web server process takes its connections from a ConnectionPool of at most DB_POOL_SIZE connections; an idle
+# connection is pinged before reuse when it sat in the pool for more than DB_POOL_HEALTH_CHECK_S.
+DB_POOL_SIZE = 4
+DB_POOL_HEALTH_CHECK_S = 30
+DB_POOL_TIMEOUT_S = 10
+# the client errors after which a connection is dropped instead of going back to the pool: server has gone away,
+# lost connection during query, lost connection to server; a deadlock or lock wait timeout leaves it usable
+DB_DISCONNECT_ERRORS = (2006, 2013, 2055)
+
+# Web servers (and browsing users) read the left coupons through a LeftCouponsCache: a count younger than
+# LEFT_COUPONS_CACHE_TTL_S is served without a query, and the process' own sign-ups lower it. Sign-ups of other
+# processes only show up after the TTL, which is fine: the count is just a hint, the sign-up transaction does the
+# authoritative check. 0 disables the cache.
+LEFT_COUPONS_CACHE_TTL_S = 0.5
+
+# list_user_coupons() pages through a user's coupons, newest first, on this secondary index of USER_COUPON_TABLE:
+# (user_id, time, promo_id) is the page order, and process_id is added so it covers the whole query.
+USER_COUPON_TIME_INDEX = 'idx_user_time'
+USER_COUPONS_PAGE_SIZE = 20
+
+# The SQL statements are built once here instead of on every call; the values always go in as parameters.
+TAKE_COUPON_SQL = f"""
+    UPDATE `{DB_NAME}`.`{RROMO_TABLE}` SET left_coupons = left_coupons - 1
+    WHERE promo_id = %(promo_id)s AND left_coupons > 0 ;
+"""
+TAKE_SHARD_COUPON_SQL = f"""
+    UPDATE `{DB_NAME}`.`{PROMO_SHARD_TABLE}` SET left_coupons = left_coupons - 1
+    WHERE promo_id = %(promo_id)s AND shard_id = %(shard_id)s AND left_coupons > 0 ;
+"""
+ADD_USER_COUPON_SQL = f"""
+    INSERT INTO `{DB_NAME}`.`{USER_COUPON_TABLE}` (user_id, promo_id, process_id)
+    VALUES (%(user_id)s, %(promo_id)s, %(process_id)s) ;
+"""
+LOCK_PROMO_SQL = f"""
+    SELECT left_coupons FROM `{DB_NAME}`.`{RROMO_TABLE}`
+    WHERE promo_id = %(promo_id)s FOR UPDATE ;
+"""
+RESERVE_COUPONS_SQL = f"""
+    UPDATE `{DB_NAME}`.`{RROMO_TABLE}` SET left_coupons = left_coupons - %(num_coupons)s
+    WHERE promo_id = %(promo_id)s AND left_coupons >= %(num_coupons)s ;
+"""
+# pymysql turns executemany() of INSERT ... VALUES into one multi-row INSERT
+ADD_USER_COUPONS_SQL = f"""
+    INSERT INTO `{DB_NAME}`.`{USER_COUPON_TABLE}` (user_id, promo_id, process_id)
+    VALUES (%s, %s, %s)
+"""
+LOCK_SHARD_SQL = f"""
+    SELECT left_coupons FROM `{DB_NAME}`.`{PROMO_SHARD_TABLE}`
+    WHERE promo_id = %(promo_id)s AND shard_id = %(shard_id)s FOR UPDATE ;
+"""
+RESERVE_SHARD_COUPONS_SQL = f"""
+    UPDATE `{DB_NAME}`.`{PROMO_SHARD_TABLE}` SET left_coupons = left_coupons - %(num_coupons)s
+    WHERE promo_id = %(promo_id)s AND shard_id = %(shard_id)s ;
+"""
+GET_PROMO_USERS_SQL = f"""
+    SELECT user_id FROM `{DB_NAME}`.`{USER_COUPON_TABLE}`
+    WHERE promo_id = %(promo_id)s ;
+"""
+GET_TOTAL_COUPONS_SQL = f"""
+    SELECT total_coupons FROM `{DB_NAME}`.`{RROMO_TABLE}`
+    WHERE promo_id = %(promo_id)s ;
+"""
+UPSERT_PROMOTION_SQL = f"""
+    INSERT INTO {DB_NAME}.{RROMO_TABLE} (promo_id, restaurant_id, total_coupons, left_coupons)
+    VALUES (%(promo_id)s, %(restaurant_id)s, %(total_coupons)s, %(left_coupons)s)
+    ON DUPLICATE KEY UPDATE total_coupons = %(total_coupons)s, left_coupons = %(left_coupons)s
+"""
+DELETE_PROMO_SHARDS_SQL = f"""
+    DELETE FROM `{DB_NAME}`.`{PROMO_SHARD_TABLE}` WHERE promo_id = %(promo_id)s ;
+"""
+INSERT_PROMO_SHARD_SQL = f"""
+    INSERT INTO `{DB_NAME}`.`{PROMO_SHARD_TABLE}` (promo_id, shard_id, left_coupons)
+    VALUES (%s, %s, %s)
+"""
+GET_LEFT_COUPONS_SQL = f"""
+    SELECT left_coupons from `{DB_NAME}`.`{RROMO_TABLE}`
+    WHERE promo_id = %(promo_id)s;
+"""
+GET_LEFT_SHARD_COUPONS_SQL = f"""
+    SELECT SUM(left_coupons) as left_coupons from `{DB_NAME}`.`{PROMO_SHARD_TABLE}`
+    WHERE promo_id = %(promo_id)s;
+"""
+GET_USER_COUPON_NUM_SQL = f"""
+    SELECT count(*) as cnt from `{DB_NAME}`.`{USER_COUPON_TABLE}`
+    WHERE promo_id = %(promo_id)s;
+"""
+# keyset pagination: seek to the row after the last one of the previous page instead of skipping OFFSET rows
+LIST_USER_COUPONS_FIRST_PAGE_SQL = f"""
+    SELECT promo_id, process_id, time FROM `{DB_NAME}`.`{USER_COUPON_TABLE}`
+    WHERE user_id = %(user_id)s
+    ORDER BY time DESC, promo_id DESC
+    LIMIT %(page_size)s ;
+"""
+LIST_USER_COUPONS_NEXT_PAGE_SQL = f"""
+    SELECT promo_id, process_id, time FROM `{DB_NAME}`.`{USER_COUPON_TABLE}`
+    WHERE user_id = %(user_id)s
+        AND (time < %(time)s OR (time = %(time)s AND promo_id < %(promo_id)s))
+    ORDER BY time DESC, promo_id DESC
+    LIMIT %(page_size)s ;
+"""
+
+
+@functools.lru_cache(maxsize=64)
+def get_signed_up_users_sql(num_users: int, for_share=False) -> str:
+    # the IN list depends on the batch size, so build it once per size; FOR SHARE reads the latest committed rows
+    # instead of the transaction's snapshot
+    placeholders = ', '.join(['%s'] * num_users)
+    return f"""
+        SELECT user_id FROM `{DB_NAME}`.`{USER_COUPON_TABLE}`
+        WHERE promo_id = %s AND user_id IN ({placeholders}) {'FOR SHARE' if for_share else ''} ;
+    """
+
 logging.basicConfig(level=logging.INFO)
 
 
@@ -51,39 +214,173 @@ def web_server_process(process_id):
                 last_user_id = str(random.randint(0, 1000_000_000))
                 yield last_user_id
 
-    conn = pymysql.connect(host='localhost',
-                           user='root',
-                           password='example',
-                           database=DB_NAME,
-                           cursorclass=pymysql.cursors.DictCursor)
+    store = COUPON_STORES[STORAGE_BACKEND]()
+    cache = LeftCouponsCache(store=store)
+    rclient = connect_redis() if REDIS_FRONTED_INVENTORY else None
+    pending_users = []
     for rand_user in user_generator():
-        left_coupon = get_left_coupons(conn)
-        if left_coupon <= 0:
-            logging.info(f'Process {process_id} found that no more left coupons in promo')
-            break
+        if REDIS_FRONTED_INVENTORY:
+            admitted = redis_admit_user(rclient, rand_user)
+            if admitted == 0:
+                logging.info(f'Process {process_id} found that no more left coupons in promo')
+                break
+            if admitted < 0:
+                logging.warning(f'Process {process_id}: Duplicated user found: {rand_user}')
+            time.sleep(random.uniform(0.1, 1.0))
+            continue
+
+        # every request checks a connection out of the store instead of holding one for the process lifetime
+        with store.connection() as conn:
+            left_coupon = cache.get(conn)
+            if left_coupon <= 0:
+                logging.info(f'Process {process_id} found that no more left coupons in promo')
+                break
 
-        user_sign_up_promo(conn, process_id, rand_user)
+            if SIGN_UP_BATCH_SIZE > 1:
+                pending_users.append(rand_user)
+                if len(pending_users) >= SIGN_UP_BATCH_SIZE:
+                    store.users_sign_up_promo(conn, process_id, pending_users, cache=cache)
+                    pending_users = []
+            else:
+                store.user_sign_up_promo(conn, process_id, rand_user, cache=cache)
         
         sleep_time = random.uniform(0.1, 1.0)
         time.sleep(sleep_time)
+
+    if pending_users:
+        with store.connection() as conn:
+            store.users_sign_up_promo(conn, process_id, pending_users, cache=cache)
+    store.close()
     
-    logging.info(f'Process {process_id} exiting')
+    logging.info(f'Process {process_id} exiting, left coupons cache: {cache.stats()}')
 
 
-def main():
-    # Create tables if they don't exist
-    conn = pymysql.connect(host='localhost',
+def connect_db():
+    return pymysql.connect(host='localhost',
                            user='root',
                            password='example',
                            database=DB_NAME,
                            cursorclass=pymysql.cursors.DictCursor)
-    create_tables_truncate(conn)
+
+
+def connect_redis():
+    # redis is only needed with REDIS_FRONTED_INVENTORY and its benchmark, so it is not imported at the top
+    import redis
+    return redis.Redis(host='localhost', port=6379, decode_responses=True)
+
+
+class ConnectionPool():
+    '''
+    A small pool of MySQL connections shared by the threads of a process.
+
+    At most max_size connections are open at a time; acquire() blocks up to timeout_s for one to come back. A
+    connection idle for more than health_check_interval_s is pinged before it is handed out, and replaced when the
+    ping fails. Returned connections are rolled back, so nobody inherits an open transaction or read snapshot.
+    '''
+    def __init__(self, max_size=DB_POOL_SIZE, health_check_interval_s=DB_POOL_HEALTH_CHECK_S,
+                 timeout_s=DB_POOL_TIMEOUT_S):
+        self.max_size = max_size
+        self.health_check_interval_s = health_check_interval_s
+        self.timeout_s = timeout_s
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.idle = queue.LifoQueue()   # (connection, time.monotonic() when it was returned)
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout_s):
+            raise TimeoutError(f'No MySQL connection available within {self.timeout_s}s')
+        try:
+            while True:
+                try:
+                    conn, idle_since = self.idle.get_nowait()
+                except queue.Empty:
+                    return connect_db()
+
+                if time.monotonic() - idle_since < self.health_check_interval_s:
+                    return conn
+                try:
+                    conn.ping(reconnect=False)
+                    return conn
+                except pymysql.err.Error:
+                    logging.warning('Dropping a broken MySQL connection from the pool')
+                    close_quietly(conn)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        try:
+            if broken:
+                close_quietly(conn)
+            else:
+                conn.rollback()
+                self.idle.put((conn, time.monotonic()))
+        except pymysql.err.Error:
+            close_quietly(conn)
+        finally:
+            self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except pymysql.err.InterfaceError:
+            self.release(conn, broken=True)
+            raise
+        except pymysql.err.OperationalError as e:
+            self.release(conn, broken=bool(e.args) and e.args[0] in DB_DISCONNECT_ERRORS)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            close_quietly(conn)
+
+
+def in_transaction(conn) -> bool:
+    if isinstance(conn, sqlite3.Connection):
+        return conn.in_transaction
+    # the status flags of the last reply from the server
+    return bool(conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS)
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except pymysql.err.Error:
+        pass
+
+
+def main():
+    if REDIS_FRONTED_INVENTORY and STORAGE_BACKEND != 'mysql':
+        raise ValueError(f'REDIS_FRONTED_INVENTORY needs the mysql storage backend, not {STORAGE_BACKEND}')
+
+    # Create tables if they don't exist
+    store = COUPON_STORES[STORAGE_BACKEND]()
+    conn = store.connect()
+    store.create_tables_truncate(conn)
 
     # Populate some initial values in promotion table
-    create_promotion(conn, total_allowed_coupon=200)
+    store.create_promotion(conn, total_allowed_coupon=200)
+
+    if REDIS_FRONTED_INVENTORY:
+        rclient = connect_redis()
+        preload_redis_inventory(conn, rclient)
+        writer_stop = Event()
+        writer = Process(target=coupon_writer_process, args=(NUM_PROCESSES, writer_stop))
+        writer.start()
 
     # start a few worker processes
     logging.info('Starting processes...')
+    start = time.perf_counter()
     processes = {}
     for i in range(NUM_PROCESSES):
         processes[i] = Process(target=web_server_process, args=(i,))
@@ -94,37 +391,320 @@ def main():
     for p in processes.values():
         p.join()
 
+    if REDIS_FRONTED_INVENTORY:
+        # the writer drains the admitted users before exiting
+        writer_stop.set()
+        writer.join()
+        reconcile_redis_inventory(conn, rclient)
+
     # Verify the sum of the left coupons and the number of added user coupons equals the total number
     #  of coupons in promotion table
-    left_coupon = get_left_coupons(conn)
-    num_user_coupons = get_user_coupon_num(conn)
+    left_coupon = store.get_left_coupons(conn)
+    num_user_coupons = store.get_user_coupon_num(conn)
     logging.info(f'Number of left coupons: {left_coupon}, and the number of user coupons: {num_user_coupons}')
+    logging.info(f'{num_user_coupons / (time.perf_counter() - start):.1f} sign-ups/sec on {STORAGE_BACKEND} '
+                 f'with {NUM_COUPON_SHARDS} shards')
     if left_coupon + num_user_coupons != 200:
         logging.error(f'Data inconsistency detected: the sum of left coupons and the used coupons is not 200')
 
     logging.info(f'MAIN: Exiting')
 
 
-def user_sign_up_promo(conn, process_id: int, user_id: str, promo_id: str=RPOMO_ID):
-    decrement_coupons = f"""
-        UPDATE `{DB_NAME}`.`{RROMO_TABLE}` SET left_coupons = left_coupons - 1
-        WHERE promo_id = %(promo_id)s ;
-    """
-    add_user_coupon = f"""
-        INSERT `{DB_NAME}`.`{USER_COUPON_TABLE}` (user_id, promo_id, process_id)
-        SELECT %(user_id)s, %(promo_id)s, {process_id}
-        FROM `{DB_NAME}`.`{RROMO_TABLE}`
-        WHERE left_coupons >= 0 ;
-    """
+def user_sign_up_promo(conn, process_id: int, user_id: str, promo_id: str=RPOMO_ID,
+                       num_shards=NUM_COUPON_SHARDS, cache=None) -> bool:
+    if num_shards > 1:
+        signed_up = user_sign_up_promo_sharded(conn, process_id, user_id, promo_id, num_shards)
+    else:
+        signed_up = False
+        with conn.cursor() as cursor:
+            try:
+                # the UPDATE is the authoritative check: it takes a coupon only when one is left, and holds the
+                # promotion row lock until we commit
+                if cursor.execute(TAKE_COUPON_SQL, {'promo_id': promo_id}) == 1:
+                    cursor.execute(ADD_USER_COUPON_SQL,
+                                   {'user_id': user_id, 'promo_id': promo_id, 'process_id': process_id})
+                    conn.commit()
+                    signed_up = True
+                else:
+                    conn.rollback()
+            except pymysql.err.IntegrityError:
+                conn.rollback()
+                logging.warning(f'Process {process_id}: Duplicated user found: {user_id}')
+            except pymysql.err.MySQLError:
+                conn.rollback()
+                raise
+
+    if cache is not None:
+        cache.take(promo_id, int(signed_up), 1)
+    return signed_up
+
+
+def get_random_shard_order(num_shards: int) -> List[int]:
+    # start from a random shard so processes spread over the shards, then fall back to the others in turn
+    first_shard = random.randrange(num_shards)
+    return [(first_shard + i) % num_shards for i in range(num_shards)]
+
+
+def user_sign_up_promo_sharded(conn, process_id: int, user_id: str, promo_id: str, num_shards: int,
+                               max_attempts=3) -> bool:
+    '''
+    Take a coupon from the first shard with one left, going through the shards in random order.
+
+    The UPDATE keeps its lock on every empty shard it went through until we commit, so two sign-ups going through the
+    shards in different order can deadlock as they drain; MySQL rolls one back and we retry it.
+    '''
+    for attempt in range(max_attempts):
+        with conn.cursor() as cursor:
+            try:
+                for shard_id in get_random_shard_order(num_shards):
+                    if cursor.execute(TAKE_SHARD_COUPON_SQL, {'promo_id': promo_id, 'shard_id': shard_id}) == 1:
+                        break
+                else:
+                    conn.rollback()
+                    return False
+
+                cursor.execute(ADD_USER_COUPON_SQL, {'user_id': user_id, 'promo_id': promo_id, 'process_id': process_id})
+                conn.commit()
+                return True
+            except pymysql.err.IntegrityError:
+                conn.rollback()
+                logging.warning(f'Process {process_id}: Duplicated user found: {user_id}')
+                return False
+            except pymysql.err.OperationalError as e:
+                conn.rollback()
+                # 1213: deadlock found when trying to get lock
+                if e.args[0] != 1213 or attempt == max_attempts - 1:
+                    raise
+
+
+def users_sign_up_promo(conn, process_id: int, user_ids: List[str], promo_id: str=RPOMO_ID,
+                        num_shards=NUM_COUPON_SHARDS, cache=None, max_attempts=3) -> List[str]:
+    '''
+    Sign up a batch of users in one transaction; returns the users who got a coupon.
 
+    The promotion row is locked first, which serializes sign-ups of the promotion (user_sign_up_promo() holds the
+    same lock from its UPDATE on). The users who already have a coupon are then read FOR SHARE: a plain SELECT reads
+    the transaction's snapshot, which may predate the lock and miss the users signed up by other processes meanwhile.
+    If the batch still does not go in as planned, it is rolled back and retried up to max_attempts times, and then
+    given up on without signing anybody up, so the process keeps serving.
+    '''
+    # keep the first occurrence of every user
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return []
+
+    winners = None
+    try:
+        if num_shards > 1:
+            winners = users_sign_up_promo_sharded(conn, process_id, user_ids, promo_id, num_shards)
+            return winners
+
+        for attempt in range(max_attempts):
+            with conn.cursor() as cursor:
+                try:
+                    cursor.execute(LOCK_PROMO_SQL, {'promo_id': promo_id})
+                    left_coupons = cursor.fetchone()['left_coupons']
+
+                    cursor.execute(get_signed_up_users_sql(len(user_ids), for_share=True), [promo_id] + user_ids)
+                    signed_up = set(row['user_id'] for row in cursor.fetchall())
+                    for user_id in signed_up:
+                        logging.warning(f'Process {process_id}: Duplicated user found: {user_id}')
+
+                    winners = [user_id for user_id in user_ids if user_id not in signed_up][:max(left_coupons, 0)]
+                    if not winners:
+                        conn.rollback()
+                        return []
+
+                    reserved = cursor.execute(RESERVE_COUPONS_SQL, {'promo_id': promo_id, 'num_coupons': len(winners)})
+                    inserted = cursor.executemany(ADD_USER_COUPONS_SQL,
+                                                  [(user_id, promo_id, process_id) for user_id in winners])
+                    if reserved == 1 and inserted == len(winners):
+                        conn.commit()
+                        return winners
+
+                    # roll back rather than let left_coupons + user coupons drift from the total
+                    conn.rollback()
+                    logging.warning(f'Process {process_id}: reserved {reserved} promotion rows and inserted {inserted} '
+                                    f'of {len(winners)} user coupons, retry the batch')
+                except pymysql.err.IntegrityError as e:
+                    conn.rollback()
+                    logging.warning(f'Process {process_id}: batch sign-up failed ({e}), retry the batch')
+                except pymysql.err.MySQLError:
+                    conn.rollback()
+                    raise
+
+        logging.error(f'Process {process_id}: batch sign-up failed {max_attempts} times, no coupon for {user_ids}')
+        winners = []
+        return winners
+    except BaseException:
+        # the batch may or may not have gone in
+        winners = None
+        raise
+    finally:
+        if cache is not None:
+            if winners is None:
+                cache.invalidate(promo_id)
+            else:
+                cache.take(promo_id, len(winners), len(user_ids))
+
+
+def users_sign_up_promo_sharded(conn, process_id: int, user_ids: List[str], promo_id: str, num_shards: int,
+                                max_attempts=3) -> List[str]:
+    '''
+    Sharded version of users_sign_up_promo(): reserve coupons from the shards in random order, then insert the
+    winners with one multi-row INSERT.
+
+    Without a single promotion row lock, a concurrent sign-up of the same user can slip in between our check and our
+    INSERT; then we roll back and sign up the batch one user at a time. Two batches locking shards in different
+    order can deadlock; MySQL rolls one back and we retry it.
+    '''
+    for attempt in range(max_attempts):
+        with conn.cursor() as cursor:
+            try:
+                cursor.execute(get_signed_up_users_sql(len(user_ids)), [promo_id] + user_ids)
+                signed_up = set(row['user_id'] for row in cursor.fetchall())
+                for user_id in signed_up:
+                    logging.warning(f'Process {process_id}: Duplicated user found: {user_id}')
+                candidates = [user_id for user_id in user_ids if user_id not in signed_up]
+
+                num_reserved = 0
+                for shard_id in get_random_shard_order(num_shards):
+                    if num_reserved == len(candidates):
+                        break
+                    cursor.execute(LOCK_SHARD_SQL, {'promo_id': promo_id, 'shard_id': shard_id})
+                    num_coupons = min(cursor.fetchone()['left_coupons'], len(candidates) - num_reserved)
+                    if num_coupons > 0:
+                        cursor.execute(RESERVE_SHARD_COUPONS_SQL,
+                                       {'promo_id': promo_id, 'shard_id': shard_id, 'num_coupons': num_coupons})
+                        num_reserved += num_coupons
+
+                winners = candidates[:num_reserved]
+                if not winners:
+                    conn.rollback()
+                    return []
+
+                cursor.executemany(ADD_USER_COUPONS_SQL, [(user_id, promo_id, process_id) for user_id in winners])
+                conn.commit()
+                return winners
+            except pymysql.err.IntegrityError:
+                conn.rollback()
+                logging.warning(f'Process {process_id}: concurrent sign-up of the same user, sign up one by one')
+                return [user_id for user_id in user_ids
+                        if user_sign_up_promo_sharded(conn, process_id, user_id, promo_id, num_shards)]
+            except pymysql.err.OperationalError as e:
+                conn.rollback()
+                # 1213: deadlock found when trying to get lock
+                if e.args[0] != 1213 or attempt == max_attempts - 1:
+                    raise
+            except pymysql.err.MySQLError:
+                conn.rollback()
+                raise
+
+
+def get_redis_inventory_keys(promo_id: str=RPOMO_ID) -> List[str]:
+    return [f'coupons_left_{promo_id}', f'coupons_users_{promo_id}', f'coupons_admitted_{promo_id}']
+
+
+def preload_redis_inventory(conn, rclient, promo_id: str=RPOMO_ID):
+    '''
+    Start the redis counter from the left coupons in MySQL; the users who already have a coupon cannot be admitted.
+    '''
+    left_key, users_key, queue_key = get_redis_inventory_keys(promo_id)
     with conn.cursor() as cursor:
-        cursor.execute(decrement_coupons, {'promo_id': RPOMO_ID, 'user_id': user_id})
-        try:
-            cursor.execute(add_user_coupon, {'promo_id': RPOMO_ID, 'user_id': user_id})
-            conn.commit()
-        except pymysql.err.IntegrityError as e:
-            conn.rollback()
-            logging.warning(f'Process {process_id}: Duplicated user found: {user_id}')
+        cursor.execute(GET_PROMO_USERS_SQL, {'promo_id': promo_id})
+        signed_up = [row['user_id'] for row in cursor.fetchall()]
+    left_coupons = get_left_coupons(conn, promo_id)
+    # end the read snapshot, or later reads on conn (reconcile_redis_inventory()) would not see the sign-ups
+    conn.commit()
+
+    pipe = rclient.pipeline(transaction=True)
+    pipe.delete(left_key, users_key, queue_key)
+    pipe.set(left_key, left_coupons)
+    if signed_up:
+        pipe.sadd(users_key, *signed_up)
+    pipe.execute()
+    logging.info(f'Preloaded {left_coupons} left coupons of promo {promo_id} into redis')
+
+
+def redis_admit_user(rclient, user_id: str, promo_id: str=RPOMO_ID) -> int:
+    '''
+    Returns 1 when the user is admitted, 0 when there is no coupon left, -1 when the user was admitted before.
+    '''
+    global admit_user_script
+    if admit_user_script is None:
+        admit_user_script = rclient.register_script(ADMIT_USER_LUA)
+    return admit_user_script(keys=get_redis_inventory_keys(promo_id), args=[user_id], client=rclient)
+
+
+def persist_admitted_users(conn, rclient, process_id: int, promo_id: str=RPOMO_ID, batch_size=WRITER_BATCH_SIZE) -> int:
+    '''
+    Write the next batch of admitted users to MySQL; returns the number of users taken from the queue.
+
+    The batch is only removed from the queue once it is committed, so a failed batch is retried as is; that is safe
+    since users_sign_up_promo() skips the users who already have a coupon. There must be one writer per promotion.
+    '''
+    _, _, queue_key = get_redis_inventory_keys(promo_id)
+    batch = rclient.lrange(queue_key, 0, batch_size - 1)
+    if not batch:
+        return 0
+
+    winners = users_sign_up_promo(conn, process_id, batch, promo_id)
+    if len(winners) != len(batch):
+        # expected when retrying a batch which was committed before, otherwise reconcile_redis_inventory() tells
+        logging.warning(f'Process {process_id}: {len(batch) - len(winners)} admitted users got no new coupon in MySQL')
+    rclient.ltrim(queue_key, len(batch), -1)
+    return len(batch)
+
+
+def coupon_writer_process(process_id, stop_event):
+    '''
+    Background writer persisting the users admitted by redis; it exits once stop_event is set and the queue is empty.
+    '''
+    conn = connect_db()
+    rclient = connect_redis()
+    while True:
+        stopping = stop_event.is_set()
+        if persist_admitted_users(conn, rclient, process_id) == 0:
+            if stopping:
+                break
+            time.sleep(0.05)
+    logging.info(f'Writer process {process_id} exiting')
+
+
+def reconcile_redis_inventory(conn, rclient, promo_id: str=RPOMO_ID) -> Dict[str, int]:
+    '''
+    Check the redis counter against MySQL: every coupon taken from the counter is either in the persist queue or
+    already in MySQL, so redis left + queued == MySQL left, and MySQL left + user coupons == total.
+
+    The first check can be off for a moment while the writer is between its commit and trimming the queue; a
+    mismatch which stays there means admitted users were lost. conn is only read from here, and whatever
+    transaction it had open is rolled back first, so the counts come from a fresh snapshot.
+    '''
+    conn.rollback()
+    left_key, _, queue_key = get_redis_inventory_keys(promo_id)
+    pipe = rclient.pipeline(transaction=True)
+    pipe.get(left_key)
+    pipe.llen(queue_key)
+    redis_left, queued = pipe.execute()
+    redis_left = int(redis_left or 0)
+
+    with conn.cursor() as cursor:
+        cursor.execute(GET_TOTAL_COUPONS_SQL, {'promo_id': promo_id})
+        row = cursor.fetchone()
+    # the counts come from the same read snapshot as the promotion row
+    mysql_left = get_left_coupons(conn, promo_id)
+    num_user_coupons = get_user_coupon_num(conn, promo_id)
+    # end the read snapshot, so the next reconciliation sees new commits
+    conn.commit()
+
+    report = {'redis_left': redis_left, 'queued': queued, 'mysql_left': mysql_left,
+              'mysql_user_coupons': num_user_coupons, 'total': row['total_coupons']}
+    if report['redis_left'] + report['queued'] != report['mysql_left'] or \
+            report['mysql_left'] + report['mysql_user_coupons'] != report['total']:
+        logging.error(f'Redis inventory does not reconcile with MySQL: {report}')
+    else:
+        logging.info(f'Redis inventory reconciles with MySQL: {report}')
+    return report
 
 
 def create_tables_truncate(conn):
@@ -143,37 +723,116 @@ def create_tables_truncate(conn):
                 `promo_id` VARCHAR(10),
                 `process_id` INT,
                 `time` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, promo_id)
+                PRIMARY KEY (user_id, promo_id),
+                KEY `{USER_COUPON_TIME_INDEX}` (user_id, time, promo_id, process_id)
+            );
+        """)
+        # tables created before the index existed
+        cursor.execute(f"""
+            SELECT 1 FROM information_schema.statistics
+            WHERE table_schema = %(db)s AND table_name = %(table)s AND index_name = %(index)s ;
+        """, {'db': DB_NAME, 'table': USER_COUPON_TABLE, 'index': USER_COUPON_TIME_INDEX})
+        if cursor.fetchone() is None:
+            cursor.execute(f"""
+                ALTER TABLE `{DB_NAME}`.`{USER_COUPON_TABLE}`
+                ADD KEY `{USER_COUPON_TIME_INDEX}` (user_id, time, promo_id, process_id) ;
+            """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS `{DB_NAME}`.`{PROMO_SHARD_TABLE}` (
+                `promo_id` VARCHAR(10),
+                `shard_id` INT,
+                `left_coupons` INT,
+                PRIMARY KEY (promo_id, shard_id)
             );
         """)
         cursor.execute(f'truncate `{DB_NAME}`.`{USER_COUPON_TABLE}`;')
+        cursor.execute(f'truncate `{DB_NAME}`.`{PROMO_SHARD_TABLE}`;')
         conn.commit()
     
     logging.info('Tables created and truncated')
 
 
-def create_promotion(conn, promo_id=RPOMO_ID, total_allowed_coupon=200):
-    insert_record = f"""
-        INSERT INTO {DB_NAME}.{RROMO_TABLE} (promo_id, restaurant_id, total_coupons, left_coupons)
-        VALUES (%(promo_id)s, %(restaurant_id)s, %(total_coupons)s, %(left_coupons)s)
-        ON DUPLICATE KEY UPDATE left_coupons = %(left_coupons)s
-    """
-
+def create_promotion(conn, promo_id=RPOMO_ID, total_allowed_coupon=200, num_shards=NUM_COUPON_SHARDS):
     with conn.cursor() as cursor:
-        cursor.execute(insert_record,
-            {'promo_id': promo_id, 'restaurant_id': '67890',
-             'total_coupons': total_allowed_coupon, 'left_coupons': total_allowed_coupon})
+        cursor.execute(UPSERT_PROMOTION_SQL,
+            {'promo_id': promo_id, 'restaurant_id': '67890', 'total_coupons': total_allowed_coupon,
+             'left_coupons': total_allowed_coupon if num_shards == 1 else None})
+        cursor.execute(DELETE_PROMO_SHARDS_SQL, {'promo_id': promo_id})
+        if num_shards > 1:
+            # spread the remainder over the first shards
+            cursor.executemany(INSERT_PROMO_SHARD_SQL,
+                [(promo_id, shard_id, total_allowed_coupon // num_shards + (shard_id < total_allowed_coupon % num_shards))
+                 for shard_id in range(num_shards)])
         conn.commit()
     logging.info(f'Created **** 200 **** coupons in the database')
 
 
-def get_left_coupons(conn, promo_id=RPOMO_ID):
+class LeftCouponsCache():
+    '''
+    Read-through cache of get_left_coupons() for one process.
+
+    A count is served for ttl_s after it was read, and lowered by take() when the process signs up users itself, so
+    sign-ups do not cost a query each. The left coupons only ever go down, so a stale count may send a user into a
+    sign-up that then fails, but never turns a user away while coupons are left.
+
+    A miss ends the read transaction it opened, so the next miss sees new sign-ups. When the caller already has a
+    transaction open on conn, it is left alone, and the count comes from the caller's snapshot.
+    '''
+    def __init__(self, ttl_s=LEFT_COUPONS_CACHE_TTL_S, store=None):
+        self.ttl_s = ttl_s
+        self.get_left_coupons = store.get_left_coupons if store is not None else get_left_coupons
+        self.entries = {}   # promo_id -> (left coupons, time.monotonic() when read)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn, promo_id=RPOMO_ID, num_shards=NUM_COUPON_SHARDS) -> int:
+        entry = self.entries.get(promo_id)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl_s:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        caller_transaction = in_transaction(conn)
+        left_coupons = self.get_left_coupons(conn, promo_id, num_shards)
+        # a plain SELECT still opens a REPEATABLE READ snapshot; end it unless it belongs to the caller
+        if not caller_transaction:
+            conn.commit()
+        if self.ttl_s > 0:
+            self.entries[promo_id] = (left_coupons, time.monotonic())
+        return left_coupons
+
+    def take(self, promo_id, num_taken: int, num_users: int):
+        '''
+        Lower the count by the coupons num_users sign-ups just took. When some of them got no coupon the promotion
+        may have run out, so the count is dropped and the next read goes to the database.
+        '''
+        entry = self.entries.get(promo_id)
+        if entry is None:
+            return
+        if num_taken < num_users:
+            self.invalidate(promo_id)
+        else:
+            # keep the read time: sign-ups of other processes still only show up after the TTL
+            self.entries[promo_id] = (max(entry[0] - num_taken, 0), entry[1])
+
+    def invalidate(self, promo_id=RPOMO_ID):
+        self.entries.pop(promo_id, None)
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f'{lookups} lookups, {self.misses} queries, {hit_rate:.1%} hit rate'
+
+
+def get_left_coupons(conn, promo_id=RPOMO_ID, num_shards=NUM_COUPON_SHARDS):
+    if num_shards > 1:
+        with conn.cursor() as cursor:
+            cursor.execute(GET_LEFT_SHARD_COUPONS_SQL, {'promo_id': promo_id})
+            # SUM() comes back as a Decimal
+            return int(cursor.fetchone()['left_coupons'])
+
     with conn.cursor() as cursor:
-        fetch_left_coupons = f"""
-            SELECT left_coupons from `{DB_NAME}`.`{RROMO_TABLE}`
-            WHERE promo_id = %(promo_id)s;
-        """
-        cursor.execute(fetch_left_coupons, {'promo_id': promo_id})
+        cursor.execute(GET_LEFT_COUPONS_SQL, {'promo_id': promo_id})
         left_coupon = cursor.fetchone()['left_coupons']
     
     return left_coupon
@@ -181,16 +840,498 @@ def get_left_coupons(conn, promo_id=RPOMO_ID):
 
 def get_user_coupon_num(conn, promo_id=RPOMO_ID):
     with conn.cursor() as cursor:
-        get_user_record = f"""
-            SELECT count(*) as cnt from `{DB_NAME}`.`{USER_COUPON_TABLE}`
-            WHERE promo_id = %(promo_id)s;
-        """
-
-        cursor.execute(get_user_record, {'promo_id': promo_id})
+        cursor.execute(GET_USER_COUPON_NUM_SQL, {'promo_id': promo_id})
         num_user_coupons = cursor.fetchone()['cnt']
     
     return num_user_coupons
 
 
+def list_user_coupons(conn, user_id: str, page_size=USER_COUPONS_PAGE_SIZE,
+                      after: Optional[Tuple]=None) -> Tuple[List[Dict], Optional[Tuple]]:
+    '''
+    One page of the coupons of a user, newest first; returns the rows and the `after` to pass for the next page,
+    which is None after the last page.
+
+    `after` is the (time, promo_id) of the last row of the previous page, so every page is one seek on
+    USER_COUPON_TIME_INDEX followed by page_size index entries, however deep into the list it is.
+    '''
+    with conn.cursor() as cursor:
+        if after is None:
+            cursor.execute(LIST_USER_COUPONS_FIRST_PAGE_SQL, {'user_id': user_id, 'page_size': page_size})
+        else:
+            cursor.execute(LIST_USER_COUPONS_NEXT_PAGE_SQL,
+                           {'user_id': user_id, 'page_size': page_size, 'time': after[0], 'promo_id': after[1]})
+        rows = cursor.fetchall()
+
+    if len(rows) < page_size:
+        return rows, None
+    return rows, (rows[-1]['time'], rows[-1]['promo_id'])
+
+
+class MySQLCouponStore():
+    '''
+    The coupon functions above on the MySQL container; connection() checks connections out of a ConnectionPool.
+    '''
+    def __init__(self):
+        self.pool = None
+
+    def connect(self):
+        return connect_db()
+
+    def connection(self):
+        if self.pool is None:
+            self.pool = ConnectionPool()
+        return self.pool.connection()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+    def create_tables_truncate(self, conn):
+        create_tables_truncate(conn)
+
+    def create_promotion(self, conn, promo_id=RPOMO_ID, total_allowed_coupon=200, num_shards=NUM_COUPON_SHARDS):
+        create_promotion(conn, promo_id, total_allowed_coupon, num_shards)
+
+    def user_sign_up_promo(self, conn, process_id: int, user_id: str, promo_id: str=RPOMO_ID,
+                           num_shards=NUM_COUPON_SHARDS, cache=None) -> bool:
+        return user_sign_up_promo(conn, process_id, user_id, promo_id, num_shards, cache)
+
+    def users_sign_up_promo(self, conn, process_id: int, user_ids: List[str], promo_id: str=RPOMO_ID,
+                            num_shards=NUM_COUPON_SHARDS, cache=None) -> List[str]:
+        return users_sign_up_promo(conn, process_id, user_ids, promo_id, num_shards, cache)
+
+    def get_left_coupons(self, conn, promo_id=RPOMO_ID, num_shards=NUM_COUPON_SHARDS):
+        return get_left_coupons(conn, promo_id, num_shards)
+
+    def get_user_coupon_num(self, conn, promo_id=RPOMO_ID):
+        return get_user_coupon_num(conn, promo_id)
+
+
+class SQLiteCouponStore():
+    '''
+    The same coupon operations on a local SQLite database file, so the challenge runs without the MySQL container.
+
+    SQLite has one writer at a time for the whole database, so there are no row locks to contend on: every sign-up
+    starts with BEGIN IMMEDIATE, which takes the write lock up front (waiting up to the busy timeout for it), and then
+    checks and updates the left coupons under it. A deferred BEGIN would read first and could then fail to upgrade
+    its lock when another process wrote in between. WAL mode lets the readers go on while a sign-up writes.
+    num_shards is accepted for the same signatures and ignored; shards cannot help with a database-wide lock.
+    '''
+    def __init__(self, db_path=SQLITE_DB_PATH, busy_timeout_s=SQLITE_BUSY_TIMEOUT_S):
+        self.db_path = db_path
+        self.busy_timeout_s = busy_timeout_s
+        self.conn = None
+
+    def connect(self):
+        # isolation_level=None: no implicit transactions, we BEGIN ourselves
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_s, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        # durable as of the last checkpoint in WAL mode, without an fsync per commit
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        # a SQLite connection is a file handle, one per process is all we need
+        if self.conn is None:
+            self.conn = self.connect()
+        try:
+            yield self.conn
+        finally:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def create_tables_truncate(self, conn):
+        conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS `{RROMO_TABLE}` (
+                `promo_id` TEXT PRIMARY KEY,
+                `restaurant_id` TEXT,
+                `total_coupons` INTEGER,
+                `left_coupons` INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS `{USER_COUPON_TABLE}` (
+                `user_id` TEXT,
+                `promo_id` TEXT,
+                `process_id` INTEGER,
+                `time` TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, promo_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS `{USER_COUPON_TIME_INDEX}`
+                ON `{USER_COUPON_TABLE}` (user_id, time, promo_id, process_id);
+            DELETE FROM `{USER_COUPON_TABLE}`;
+        """)
+        logging.info(f'Tables created and truncated in {self.db_path}')
+
+    def create_promotion(self, conn, promo_id=RPOMO_ID, total_allowed_coupon=200, num_shards=NUM_COUPON_SHARDS):
+        with conn:
+            conn.execute(f"""
+                INSERT INTO `{RROMO_TABLE}` (promo_id, restaurant_id, total_coupons, left_coupons)
+                VALUES (:promo_id, :restaurant_id, :total_coupons, :total_coupons)
+                ON CONFLICT (promo_id) DO UPDATE SET total_coupons = :total_coupons, left_coupons = :total_coupons
+            """, {'promo_id': promo_id, 'restaurant_id': '1', 'total_coupons': total_allowed_coupon})
+        logging.info(f'Created {total_allowed_coupon} coupons in {self.db_path}')
+
+    def user_sign_up_promo(self, conn, process_id: int, user_id: str, promo_id: str=RPOMO_ID,
+                           num_shards=NUM_COUPON_SHARDS, cache=None) -> bool:
+        signed_up = False
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            taken = conn.execute(f"""
+                UPDATE `{RROMO_TABLE}` SET left_coupons = left_coupons - 1
+                WHERE promo_id = ? AND left_coupons > 0
+            """, (promo_id,)).rowcount
+            if taken == 1:
+                conn.execute(f"""
+                    INSERT INTO `{USER_COUPON_TABLE}` (user_id, promo_id, process_id) VALUES (?, ?, ?)
+                """, (user_id, promo_id, process_id))
+                signed_up = True
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            logging.warning(f'Process {process_id}: Duplicated user found: {user_id}')
+        except BaseException:
+            conn.rollback()
+            raise
+
+        if cache is not None:
+            cache.take(promo_id, int(signed_up), 1)
+        return signed_up
+
+    def users_sign_up_promo(self, conn, process_id: int, user_ids: List[str], promo_id: str=RPOMO_ID,
+                            num_shards=NUM_COUPON_SHARDS, cache=None) -> List[str]:
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return []
+
+        winners = None
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            left_coupons = conn.execute(f'SELECT left_coupons FROM `{RROMO_TABLE}` WHERE promo_id = ?',
+                                        (promo_id,)).fetchone()['left_coupons']
+            placeholders = ', '.join(['?'] * len(user_ids))
+            signed_up = set(row['user_id'] for row in conn.execute(f"""
+                SELECT user_id FROM `{USER_COUPON_TABLE}` WHERE promo_id = ? AND user_id IN ({placeholders})
+            """, [promo_id] + user_ids))
+            for user_id in signed_up:
+                logging.warning(f'Process {process_id}: Duplicated user found: {user_id}')
+
+            winners = [user_id for user_id in user_ids if user_id not in signed_up][:max(left_coupons, 0)]
+            if winners:
+                conn.execute(f'UPDATE `{RROMO_TABLE}` SET left_coupons = left_coupons - ? WHERE promo_id = ?',
+                             (len(winners), promo_id))
+                conn.executemany(f"""
+                    INSERT INTO `{USER_COUPON_TABLE}` (user_id, promo_id, process_id) VALUES (?, ?, ?)
+                """, [(user_id, promo_id, process_id) for user_id in winners])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            winners = None
+            raise
+        finally:
+            if cache is not None:
+                if winners is None:
+                    cache.invalidate(promo_id)
+                else:
+                    cache.take(promo_id, len(winners), len(user_ids))
+
+        return winners
+
+    def get_left_coupons(self, conn, promo_id=RPOMO_ID, num_shards=NUM_COUPON_SHARDS):
+        return conn.execute(f'SELECT left_coupons FROM `{RROMO_TABLE}` WHERE promo_id = ?',
+                            (promo_id,)).fetchone()['left_coupons']
+
+    def get_user_coupon_num(self, conn, promo_id=RPOMO_ID):
+        return conn.execute(f'SELECT count(*) AS cnt FROM `{USER_COUPON_TABLE}` WHERE promo_id = ?',
+                            (promo_id,)).fetchone()['cnt']
+
+
+COUPON_STORES = {
+    'mysql': MySQLCouponStore,
+    'sqlite': SQLiteCouponStore,
+}
+
+
+def benchmark_sign_up_process(process_id, use_redis: bool, num_users: int, result_que, num_shards=NUM_COUPON_SHARDS):
+    conn = connect_db()
+    rclient = connect_redis() if use_redis else None
+    user_ids = [f'{process_id}{i:08}' for i in range(num_users)]
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        if use_redis:
+            redis_admit_user(rclient, user_id)
+        else:
+            user_sign_up_promo(conn, process_id, user_id, num_shards=num_shards)
+    result_que.put(time.perf_counter() - start)
+
+
+def collect_process_results(processes: List[Process], result_que) -> List:
+    '''
+    Wait for the benchmark processes and return what they put into result_que; a process that died without a
+    result is reported instead of waiting for it forever.
+    '''
+    for p in processes:
+        p.join()
+    exit_codes = [p.exitcode for p in processes if p.exitcode != 0]
+    if exit_codes:
+        raise RuntimeError(f'{len(exit_codes)} benchmark processes failed, exit codes: {exit_codes}')
+    return [result_que.get() for _ in processes]
+
+
+def benchmark_redis_inventory(num_processes=8, num_users=500):
+    '''
+    Sign-up throughput of num_processes processes contending on the promotion row, against admitting through the
+    redis counter (and the time the writer then needs to persist everything to MySQL).
+    '''
+    conn = connect_db()
+    rclient = connect_redis()
+    total_users = num_processes * num_users
+
+    for name, use_redis in (('MySQL promotion row', False), ('redis counter', True)):
+        create_tables_truncate(conn)
+        create_promotion(conn, total_allowed_coupon=total_users)
+        if use_redis:
+            preload_redis_inventory(conn, rclient)
+
+        result_que = Queue()
+        processes = [Process(target=benchmark_sign_up_process, args=(i, use_redis, num_users, result_que))
+                     for i in range(num_processes)]
+        for p in processes:
+            p.start()
+        elapsed = max(collect_process_results(processes, result_que))
+        logging.info(f'BENCHMARK {name}: {total_users / elapsed:.0f} sign-ups/sec with {num_processes} processes')
+
+        if use_redis:
+            start = time.perf_counter()
+            while persist_admitted_users(conn, rclient, num_processes):
+                pass
+            elapsed = time.perf_counter() - start
+            logging.info(f'BENCHMARK writer persisted {total_users} users in {elapsed:.2f}s, '
+                         f'{total_users / elapsed:.0f} users/sec')
+            reconcile_redis_inventory(conn, rclient)
+
+
+def benchmark_shards(num_processes=8, num_users=500, shard_counts=(1, 2, 4, 8, 16)):
+    '''
+    Sign-ups per second of num_processes processes signing up users back to back, against the number of shards.
+    '''
+    conn = connect_db()
+    total_users = num_processes * num_users
+
+    for num_shards in shard_counts:
+        create_tables_truncate(conn)
+        create_promotion(conn, total_allowed_coupon=total_users, num_shards=num_shards)
+
+        result_que = Queue()
+        processes = [Process(target=benchmark_sign_up_process, args=(i, False, num_users, result_que, num_shards))
+                     for i in range(num_processes)]
+        for p in processes:
+            p.start()
+        elapsed = max(collect_process_results(processes, result_que))
+
+        left_coupons = get_left_coupons(conn, num_shards=num_shards)
+        num_user_coupons = get_user_coupon_num(conn)
+        conn.commit()
+        if left_coupons + num_user_coupons != total_users:
+            logging.error(f'BENCHMARK {num_shards} shards: {left_coupons} left + {num_user_coupons} user coupons '
+                          f'!= {total_users}')
+        logging.info(f'BENCHMARK {num_shards:2} shards: {num_user_coupons / elapsed:.0f} sign-ups/sec '
+                     f'with {num_processes} processes')
+
+
+def benchmark_pool(num_calls=2000):
+    '''
+    Per-call overhead of get_left_coupons() with a fresh connection per call against a pooled connection, and of
+    building the query string on every call against the prebuilt statement.
+    '''
+    conn = connect_db()
+    create_tables_truncate(conn)
+    create_promotion(conn)
+    conn.close()
+
+    start = time.perf_counter()
+    for _ in range(num_calls // 10):
+        conn = connect_db()
+        get_left_coupons(conn)
+        conn.close()
+    per_call = (time.perf_counter() - start) / (num_calls // 10)
+    logging.info(f'BENCHMARK connect per call: {per_call * 1e6:.0f} us/call')
+
+    pool = ConnectionPool()
+    start = time.perf_counter()
+    for _ in range(num_calls):
+        with pool.connection() as conn:
+            get_left_coupons(conn)
+    per_call = (time.perf_counter() - start) / num_calls
+    logging.info(f'BENCHMARK pooled connection: {per_call * 1e6:.0f} us/call')
+    pool.close()
+
+    num_builds = num_calls * 100
+    start = time.perf_counter()
+    for _ in range(num_builds):
+        sql = f"""
+            SELECT left_coupons from `{DB_NAME}`.`{RROMO_TABLE}`
+            WHERE promo_id = %(promo_id)s;
+        """
+    per_build = (time.perf_counter() - start) / num_builds
+    start = time.perf_counter()
+    for _ in range(num_builds):
+        sql = GET_LEFT_COUPONS_SQL
+    per_lookup = (time.perf_counter() - start) / num_builds
+    logging.info(f'BENCHMARK statement per call: built {per_build * 1e9:.0f} ns, prebuilt {per_lookup * 1e9:.0f} ns')
+
+
+def benchmark_left_coupons_cache(duration_s=5, sign_up_every=20, ttl_s=LEFT_COUPONS_CACHE_TTL_S):
+    '''
+    Browsing traffic: reads of the left coupons, with a sign-up every sign_up_every reads, for duration_s, against
+    the database directly and through a LeftCouponsCache; reports the read QPS that reaches MySQL.
+    '''
+    conn = connect_db()
+
+    for name, cache_ttl_s in (('no cache', 0), (f'cache ttl {ttl_s}s', ttl_s)):
+        create_tables_truncate(conn)
+        create_promotion(conn, total_allowed_coupon=1000_000)
+        cache = LeftCouponsCache(ttl_s=cache_ttl_s)
+
+        num_reads = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration_s:
+            cache.get(conn)
+            num_reads += 1
+            if num_reads % sign_up_every == 0:
+                user_sign_up_promo(conn, 0, str(num_reads), cache=cache)
+        elapsed = time.perf_counter() - start
+
+        logging.info(f'BENCHMARK {name}: {num_reads / elapsed:.0f} reads/sec, {cache.misses / elapsed:.0f} MySQL '
+                     f'reads/sec ({1 - cache.misses / num_reads:.1%} fewer), {cache.stats()}')
+
+
+def benchmark_user_coupons_pagination(num_rows=1000_000, num_users=10, page_size=USER_COUPONS_PAGE_SIZE,
+                                      insert_batch_size=10_000, sample_pages=(1, 10, 100, 1000, 4999)):
+    '''
+    Page fetch latency of list_user_coupons() against LIMIT ... OFFSET, over num_rows user coupons spread over
+    num_users users, at a few page numbers of the first user's list.
+    '''
+    conn = connect_db()
+    create_tables_truncate(conn)
+
+    rows_per_user = num_rows // num_users
+    base_time = 1_700_000_000
+    start = time.perf_counter()
+    with conn.cursor() as cursor:
+        for batch_start in range(0, num_rows, insert_batch_size):
+            # several coupons per second, so pages have to break ties on promo_id
+            cursor.executemany(f"""
+                INSERT INTO `{DB_NAME}`.`{USER_COUPON_TABLE}` (user_id, promo_id, process_id, time)
+                VALUES (%s, %s, %s, FROM_UNIXTIME(%s))
+            """, [(str(i % num_users), str(i // num_users), 0, base_time + i // (num_users * 4))
+                  for i in range(batch_start, min(batch_start + insert_batch_size, num_rows))])
+            conn.commit()
+        cursor.execute(f'ANALYZE TABLE `{DB_NAME}`.`{USER_COUPON_TABLE}`;')
+        cursor.fetchall()
+        cursor.execute('EXPLAIN ' + LIST_USER_COUPONS_NEXT_PAGE_SQL,
+                       {'user_id': '0', 'page_size': page_size, 'time': '2030-01-01', 'promo_id': ''})
+        plan = cursor.fetchone()
+    logging.info(f'BENCHMARK inserted {num_rows} user coupons in {time.perf_counter() - start:.1f}s; '
+                 f'keyset plan: key {plan["key"]}, {plan["Extra"]}')
+
+    # walk the whole list with keyset pagination, remembering how long each page took
+    page_times, after, seen = [], None, 0
+    while True:
+        page_start = time.perf_counter()
+        rows, after = list_user_coupons(conn, '0', page_size, after)
+        page_times.append(time.perf_counter() - page_start)
+        seen += len(rows)
+        if after is None:
+            break
+    conn.commit()
+    if seen != rows_per_user:
+        logging.error(f'BENCHMARK keyset pagination returned {seen} coupons instead of {rows_per_user}')
+
+    with conn.cursor() as cursor:
+        for page in sample_pages:
+            if page > len(page_times):
+                continue
+            offset_start = time.perf_counter()
+            cursor.execute(f"""
+                SELECT promo_id, process_id, time FROM `{DB_NAME}`.`{USER_COUPON_TABLE}`
+                WHERE user_id = %(user_id)s
+                ORDER BY time DESC, promo_id DESC
+                LIMIT %(page_size)s OFFSET %(offset)s ;
+            """, {'user_id': '0', 'page_size': page_size, 'offset': (page - 1) * page_size})
+            cursor.fetchall()
+            offset_elapsed = time.perf_counter() - offset_start
+            logging.info(f'BENCHMARK page {page:5}: keyset {page_times[page - 1] * 1000:.2f} ms, '
+                         f'OFFSET {offset_elapsed * 1000:.2f} ms')
+    conn.commit()
+
+
+def benchmark_store_sign_up_process(backend: str, process_id, num_users: int, batch_size: int, result_que):
+    store = COUPON_STORES[backend]()
+    conn = store.connect()
+    user_ids = [f'{process_id}{i:08}' for i in range(num_users)]
+
+    start = time.perf_counter()
+    for i in range(0, num_users, batch_size):
+        if batch_size > 1:
+            store.users_sign_up_promo(conn, process_id, user_ids[i:i + batch_size])
+        else:
+            store.user_sign_up_promo(conn, process_id, user_ids[i])
+    result_que.put(time.perf_counter() - start)
+    conn.close()
+
+
+def benchmark_sqlite(num_processes=8, num_users=500, batch_sizes=(1, SIGN_UP_BATCH_SIZE)):
+    '''
+    Sign-ups per second of num_processes processes signing up users back to back on the SQLite store, one user per
+    transaction and in batches; needs neither of the containers.
+    '''
+    store = SQLiteCouponStore()
+    conn = store.connect()
+    total_users = num_processes * num_users
+
+    for batch_size in batch_sizes:
+        store.create_tables_truncate(conn)
+        store.create_promotion(conn, total_allowed_coupon=total_users)
+
+        result_que = Queue()
+        processes = [Process(target=benchmark_store_sign_up_process,
+                             args=('sqlite', i, num_users, batch_size, result_que))
+                     for i in range(num_processes)]
+        for p in processes:
+            p.start()
+        elapsed = max(collect_process_results(processes, result_que))
+
+        left_coupons = store.get_left_coupons(conn)
+        num_user_coupons = store.get_user_coupon_num(conn)
+        if left_coupons + num_user_coupons != total_users:
+            logging.error(f'BENCHMARK sqlite batch {batch_size}: {left_coupons} left + {num_user_coupons} user '
+                          f'coupons != {total_users}')
+        logging.info(f'BENCHMARK sqlite batch {batch_size:2}: {num_user_coupons / elapsed:.0f} sign-ups/sec '
+                     f'with {num_processes} processes')
+
+
+BENCHMARKS = {
+    'redis_inventory': benchmark_redis_inventory,
+    'shards': benchmark_shards,
+    'pool': benchmark_pool,
+    'left_coupons_cache': benchmark_left_coupons_cache,
+    'user_coupons_pagination': benchmark_user_coupons_pagination,
+    'sqlite': benchmark_sqlite,
+}
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # python3 challenge_coupons.py benchmark [name ...]
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        for name in (sys.argv[2:] or BENCHMARKS.keys()):
+            BENCHMARKS[name]()
+    else:
+        main()
\ No newline at end of file
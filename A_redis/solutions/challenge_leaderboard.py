@@ -9,10 +9,16 @@ Implement:
 - get_user_rank(): get rank of a specific player
 """
 
-from typing import Dict
+from typing import Dict, List, Optional
 import logging
 import time
 import random 
+import queue
+import sys
+import bisect
+import threading
+import heapq
+import zlib
 
 from multiprocessing import Process, Queue
 import redis
@@ -21,10 +27,66 @@ import redis
 NUM_PROCESSES = 2
 NUM_PLAYERS = 100
 LEADERBOARD_KEY = 'leaderboard'
+
+# worker drains up to BATCH_SIZE scores (or waits at most BATCH_TIMEOUT_MS) and writes them with one ZADD;
+# set BATCH_SIZE to 1 to go back to one ZADD round trip per score
+BATCH_SIZE = 100
+BATCH_TIMEOUT_MS = 10
+
+# the local top-N cache keeps a few extra entries below N, so a top player dropping out rarely forces a reload;
+# it reloads from Redis anyway once its content is older than TOP_CACHE_MAX_STALENESS_S, to pick up the scores
+# written by other processes
+TOP_CACHE_MARGIN = 20
+TOP_CACHE_MAX_STALENESS_S = 1.0
+
+# with NUM_SHARDS > 1, users are hashed across NUM_SHARDS sorted sets instead of the single LEADERBOARD_KEY
+NUM_SHARDS = 1
+
+# with SCORE_HISTOGRAM, every write also keeps a count of users per score bucket in a hash next to its leaderboard
+# shard, so get_user_rank_approx() can answer in O(number of buckets) instead of asking the sorted sets.
+# It is off by default because it makes every write run a Lua script instead of a plain ZADD.
+SCORE_HISTOGRAM = False
+SCORE_BUCKET_WIDTH = 100
+
+# KEYS[1]: leaderboard (shard) key, KEYS[2]: histogram key of that shard; ARGV: bucket width, then member/score pairs.
+# Moving the user from the bucket of the old score to the bucket of the new score has to be atomic with the ZADD,
+# otherwise two processes updating the same user could count the user twice.
+ZADD_WITH_HISTOGRAM_LUA = '''
+local width = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    local member, score = ARGV[i], ARGV[i + 1]
+    local old = redis.call('ZSCORE', KEYS[1], member)
+    if old then
+        redis.call('HINCRBY', KEYS[2], string.format('%d', math.floor(tonumber(old) / width)), -1)
+    end
+    redis.call('ZADD', KEYS[1], score, member)
+    redis.call('HINCRBY', KEYS[2], string.format('%d', math.floor(tonumber(score) / width)), 1)
+end
+'''
+# the Script object of ZADD_WITH_HISTOGRAM_LUA, registered once on first use
+zadd_with_histogram_script = None
+
+# with WINDOWED_LEADERBOARDS, every write also goes to rolling window leaderboards, which rank users by their best
+# score inside the window. A window is made of a number of time buckets, each bucket being one sorted set that
+# expires on its own; the window itself is a ZUNIONSTORE rollup of its buckets, built once when a new bucket opens,
+# and then kept up to date by the writes, so a window query is a single ZREVRANGE/ZREVRANK like the all-time one.
+# The window keys are not sharded, so with WINDOWED_LEADERBOARDS every score also goes through a few single keys;
+# it is off by default and turned on by the windows benchmark.
+WINDOWED_LEADERBOARDS = False
+# window name -> (bucket length in seconds, number of buckets); the window covers the current bucket and the
+# previous (number of buckets - 1) ones
+WINDOWS = {
+    'hourly': (300, 12),
+    'daily': (3600, 24),
+    'weekly': (86400, 7),
+}
+# window name -> bucket start the rollup is built for, to avoid asking redis on every write
+built_window_rollups = {}
+
 logging.basicConfig(level=logging.INFO)
 
 
-def worker_process(process_id, rcv_que):
+def worker_process(process_id, rcv_que, histogram=SCORE_HISTOGRAM):
     """
     This emulates the web server process, which receives the new scores of users.
 
@@ -37,20 +99,50 @@ def worker_process(process_id, rcv_que):
 
     # Wait for messages from the message handler, and also publish messages occasionally
     while True:
+        if BATCH_SIZE > 1:
+            msgs = drain_queue(rcv_que, BATCH_SIZE, BATCH_TIMEOUT_MS)
+            receive_user_new_scores(rl, msgs, histogram=histogram)
+            continue
+
         msg = rcv_que.get(block=True)
         # logging.info(f'PROCESS {process_id} recsived {msg}')
 
         user_id = msg[0]
         score = msg[1]
-        receive_user_new_score(rl, user_id, score)
+        receive_user_new_score(rl, user_id, score, histogram=histogram)
+
+
+def drain_queue(rcv_que, max_items: int, timeout_ms: int) -> List:
+    '''
+    Block for the first message, then keep pulling until max_items messages are collected or timeout_ms
+    has passed since the first message arrived.
+    '''
+    msgs = [rcv_que.get(block=True)]
+    deadline = time.monotonic() + timeout_ms / 1000
+    while len(msgs) < max_items:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            msgs.append(rcv_que.get(block=True, timeout=remaining))
+        except queue.Empty:
+            break
+    return msgs
 
 
-def main():
+def main(histogram=SCORE_HISTOGRAM):
+    '''
+    With histogram, the workers also keep the score histograms, and the check of the ranks reports the error of the
+    approximate rank and percentile too; `python3 challenge_leaderboard.py histogram` runs it that way.
+    '''
     random.seed(1)
     
     # clean up the left over from last round
     rl = redis.Redis(host='localhost', port=6379, decode_responses=True)
-    rl.delete(LEADERBOARD_KEY)
+    rl.delete(*get_leaderboard_keys(), *get_histogram_keys())
+    for window in WINDOWS:
+        for key in rl.scan_iter(f'{LEADERBOARD_KEY}_{window}_*'):
+            rl.delete(key)
 
     # start a few worker processes, and use queue to send user score update
     logging.info('Starting processes...')
@@ -60,18 +152,23 @@ def main():
         sq = Queue()
         send_ques.append(sq)
 
-        processes.append(Process(target=worker_process, args=(i, sq)))
+        processes.append(Process(target=worker_process, args=(i, sq, histogram)))
         processes[-1].start()
     
     # build a local list to track user scores, so we can verify the result
     user_scores = [-1] * NUM_PLAYERS
 
+    # the main process sees the whole score stream, so its top players cache never needs the staleness reload
+    top_cache = TopPlayersCache(rl, top_n=3, max_staleness_s=60)
+    top_cache.reload()
+
     # update user scores
     logging.info('Update user scores...')
     for i in range(1000):
         user_id = random.randint(0, NUM_PLAYERS-1)
         score = random.randint(0, 10000)
         user_scores[user_id] = score
+        top_cache.on_new_score(user_id, score)
 
         # Send the user id and score to the worker process
         process_to_update = random.randint(0, len(processes)-1)
@@ -103,6 +200,21 @@ def main():
         else:
             logging.warning(f'NOT matched! Rank of user ({user_id}) is (factual_rank: {factual_rank}) and reported rank: {rank})')
 
+        if histogram:
+            approx_rank = get_user_rank_approx(rl, user_id)
+            approx_percentile = get_user_percentile_approx(rl, user_id)
+            num_scored = sum(1 for score in user_scores if score >= 0)
+            logging.info(f'Approximate rank of user ({user_id}) is {approx_rank} (error: {approx_rank - factual_rank}), '
+                         f'top {approx_percentile * 100:.1f}% (factual: top {factual_rank / num_scored * 100:.1f}%)')
+
+    # Verify the locally cached top players against redis
+    cached_top = get_top_players(rl, top_n=3, cache=top_cache)
+    redis_top = get_top_players(rl, top_n=3)
+    if cached_top == redis_top:
+        logging.info(f'MATCHED! Cached top players: {cached_top}')
+    else:
+        logging.warning(f'NOT matched! Cached top players: {cached_top}, top players in redis: {redis_top}')
+
     # Try to stop all processes
     for proc in processes:
         proc.terminate()
@@ -110,19 +222,484 @@ def main():
         proc.join()
 
 
-def receive_user_new_score(rclient, user_id: int, score: int):
-    rclient.zadd(LEADERBOARD_KEY, {user_id: score})
+def get_leaderboard_keys(num_shards=NUM_SHARDS) -> List[str]:
+    if num_shards == 1:
+        return [LEADERBOARD_KEY]
+    return [f'{LEADERBOARD_KEY}_shard_{i}' for i in range(num_shards)]
+
+
+def get_leaderboard_key(user_id, num_shards=NUM_SHARDS) -> str:
+    # python's hash() of a str is randomized per process, so use crc32 to agree across worker processes
+    if num_shards == 1:
+        return LEADERBOARD_KEY
+    return f'{LEADERBOARD_KEY}_shard_{zlib.crc32(str(user_id).encode()) % num_shards}'
+
+
+def get_histogram_key(leaderboard_key: str) -> str:
+    # the hash tag puts the histogram in the same cluster slot as its shard, so the Lua script can touch both
+    return f'{{{leaderboard_key}}}_histogram'
+
+
+def get_histogram_keys(num_shards=NUM_SHARDS) -> List[str]:
+    return [get_histogram_key(key) for key in get_leaderboard_keys(num_shards)]
+
+
+def receive_user_new_score(rclient, user_id: int, score: int, cache=None, num_shards=NUM_SHARDS,
+                           windowed=WINDOWED_LEADERBOARDS, now: Optional[float] = None, histogram=SCORE_HISTOGRAM):
+    pipe = rclient.pipeline(transaction=False)
+    if histogram:
+        zadd_with_histogram(rclient, get_leaderboard_key(user_id, num_shards), {user_id: score}, pipe=pipe)
+    else:
+        pipe.zadd(get_leaderboard_key(user_id, num_shards), {user_id: score})
+    if windowed:
+        add_window_scores(rclient, pipe, {user_id: score}, now)
+    pipe.execute()
+
+    if cache:
+        cache.on_new_score(user_id, score)
+
+
+def receive_user_new_scores(rclient, msgs: List, cache=None, num_shards=NUM_SHARDS, windowed=WINDOWED_LEADERBOARDS,
+                            now: Optional[float] = None, histogram=SCORE_HISTOGRAM):
+    '''
+    Batched version of receive_user_new_score(); msgs is a list of [user_id, score] in arrival order.
+    '''
+    # the later score of the same user wins, same as sending one ZADD per message in order
+    mapping = {}
+    for user_id, score in msgs:
+        mapping[user_id] = score
+
+    shard_mappings = {}
+    for user_id, score in mapping.items():
+        shard_mappings.setdefault(get_leaderboard_key(user_id, num_shards), {})[user_id] = score
+
+    pipe = rclient.pipeline(transaction=False)
+    for key, shard_mapping in shard_mappings.items():
+        if histogram:
+            zadd_with_histogram(rclient, key, shard_mapping, pipe=pipe)
+        else:
+            pipe.zadd(key, shard_mapping)
+    if windowed:
+        # unlike the all-time leaderboard, the windows keep the best score of the user
+        best_scores = {}
+        for user_id, score in msgs:
+            best_scores[user_id] = max(score, best_scores.get(user_id, score))
+        add_window_scores(rclient, pipe, best_scores, now)
+    pipe.execute()
+
+    if cache:
+        for user_id, score in mapping.items():
+            cache.on_new_score(user_id, score)
+
+
+def zadd_with_histogram(rclient, key: str, mapping: Dict, pipe=None):
+    global zadd_with_histogram_script
+    if zadd_with_histogram_script is None:
+        zadd_with_histogram_script = rclient.register_script(ZADD_WITH_HISTOGRAM_LUA)
+
+    args = [SCORE_BUCKET_WIDTH]
+    for user_id, score in mapping.items():
+        args += [user_id, score]
+    zadd_with_histogram_script(keys=[key, get_histogram_key(key)], args=args, client=pipe if pipe is not None else rclient)
+
+
+def get_window_bucket_start(window: str, now: Optional[float] = None) -> int:
+    bucket_s, _ = WINDOWS[window]
+    now = time.time() if now is None else now
+    return int(now // bucket_s) * bucket_s
+
+
+def get_window_bucket_key(window: str, bucket_start: int) -> str:
+    return f'{LEADERBOARD_KEY}_{window}_{bucket_start}'
+
+
+def get_window_rollup_key(window: str, bucket_start: int) -> str:
+    return f'{LEADERBOARD_KEY}_{window}_rollup_{bucket_start}'
+
+
+def ensure_window_rollup(rclient, window: str, now: Optional[float] = None) -> Optional[float]:
+    '''
+    Build the rollup of the window for the current bucket if nobody has done it yet.
+
+    Returns the rebuild time in seconds, or None when the rollup is already there.
+    '''
+    bucket_s, num_buckets = WINDOWS[window]
+    bucket_start = get_window_bucket_start(window, now)
+    if built_window_rollups.get(window) == bucket_start:
+        return None
 
+    rollup_key = get_window_rollup_key(window, bucket_start)
+    built_marker_key = f'{rollup_key}_built'
+    elapsed = None
+    if not rclient.exists(built_marker_key):
+        # The current bucket is part of the union, so the writes which reached the rollup before it was built are
+        # not lost; several processes rebuilding at the same time all end up with the same content.
+        start = time.perf_counter()
+        bucket_keys = [get_window_bucket_key(window, bucket_start - i * bucket_s) for i in range(num_buckets)]
+        pipe = rclient.pipeline(transaction=True)
+        pipe.zunionstore(rollup_key, bucket_keys, aggregate='MAX')
+        pipe.expire(rollup_key, bucket_s * 2)
+        pipe.set(built_marker_key, 1, ex=bucket_s * 2)
+        pipe.execute()
+        elapsed = time.perf_counter() - start
 
-def get_top_players(rclient, top_n=3) -> Dict[int, int]:
-    raw_uids = rclient.zrevrange(LEADERBOARD_KEY, 0, top_n)
+    built_window_rollups[window] = bucket_start
+    return elapsed
+
+
+def add_window_scores(rclient, pipe, mapping: Dict, now: Optional[float] = None):
+    for window, (bucket_s, num_buckets) in WINDOWS.items():
+        ensure_window_rollup(rclient, window, now)
+        bucket_start = get_window_bucket_start(window, now)
+        bucket_key = get_window_bucket_key(window, bucket_start)
+
+        pipe.zadd(bucket_key, mapping, gt=True)
+        pipe.expire(bucket_key, bucket_s * (num_buckets + 1))
+        pipe.zadd(get_window_rollup_key(window, bucket_start), mapping, gt=True)
+
+
+def get_window_top_players(rclient, window: str, top_n=3, now: Optional[float] = None) -> List[int]:
+    ensure_window_rollup(rclient, window, now)
+    rollup_key = get_window_rollup_key(window, get_window_bucket_start(window, now))
+    raw_uids = rclient.zrevrange(rollup_key, 0, top_n - 1)
+    return [int(id_str) for id_str in raw_uids]
+
+
+def get_user_window_rank(rclient, window: str, user_id: int, now: Optional[float] = None):
+    ensure_window_rollup(rclient, window, now)
+    rollup_key = get_window_rollup_key(window, get_window_bucket_start(window, now))
+    return rclient.zrevrank(rollup_key, user_id)
+
+
+def get_top_players(rclient, top_n=3, cache=None, num_shards=NUM_SHARDS) -> List[int]:
+    if cache:
+        return cache.get_top_players(top_n)
+
+    if num_shards == 1:
+        # the end index of zrevrange is inclusive
+        raw_uids = rclient.zrevrange(LEADERBOARD_KEY, 0, top_n - 1)
+    else:
+        raw_uids = [member for member, _ in get_top_entries(rclient, top_n, num_shards)]
     uids = [int(id_str) for id_str in raw_uids]
     return uids
 
 
-def get_user_rank(rclient, user_id: int):
-    return rclient.zrevrank(LEADERBOARD_KEY, user_id)
+def get_top_entries(rclient, top_n: int, num_shards=NUM_SHARDS) -> List:
+    '''
+    Return the top_n (member, score) pairs in ZREVRANGE order, merging the heads of all shards.
+    '''
+    pipe = rclient.pipeline(transaction=False)
+    for key in get_leaderboard_keys(num_shards):
+        pipe.zrevrange(key, 0, top_n - 1, withscores=True)
+    shard_heads = pipe.execute()
+
+    # every shard head is sorted by (score, member) descending, so a k-way merge keeps ZREVRANGE's order
+    merged = heapq.merge(*shard_heads, key=lambda entry: (entry[1], str(entry[0])), reverse=True)
+    return list(merged)[:top_n]
+
+
+class TopPlayersCache():
+    '''
+    In-process copy of the head of the leaderboard, patched from the score stream so reads stay local.
+
+    The cache holds the exact top entries of the sorted set (at most top_n + margin of them). A new score either
+    moves a user inside the head, or is ignored because it is below the head; the only case we cannot patch is a
+    cached user dropping below the head while the head has fewer than top_n entries left, and then we reload.
+    Entries are ordered like ZREVRANGE: by score, then by member string, both descending.
+    '''
+    def __init__(self, rclient, top_n=10, margin=TOP_CACHE_MARGIN, max_staleness_s=TOP_CACHE_MAX_STALENESS_S,
+                 num_shards=NUM_SHARDS):
+        self.rclient = rclient
+        self.num_shards = num_shards
+        self.top_n = top_n
+        self.capacity = top_n + margin
+        self.max_staleness_s = max_staleness_s
+
+        self.lock = threading.Lock()
+        self.entries = []       # ascending list of (score, member); the best player is the last one
+        self.members = {}       # member -> score, for the members in entries
+        self.complete = False   # True when the whole sorted set fits into entries
+        self.loaded_at = None   # monotonic time of the last reload; None forces a reload
+
+        self.hits = 0
+        self.reloads = 0
+
+    def reload(self):
+        raw = get_top_entries(self.rclient, self.capacity, self.num_shards)
+        entries = [(score, str(member)) for member, score in reversed(raw)]
+        self.entries = entries
+        self.members = {member: score for score, member in entries}
+        self.complete = len(entries) < self.capacity
+        self.loaded_at = time.monotonic()
+        self.reloads += 1
+
+    def on_new_score(self, user_id, score):
+        member = str(user_id)
+        score = float(score)
+        with self.lock:
+            if self.loaded_at is None:
+                return
+
+            if member in self.members:
+                self.entries.remove((self.members.pop(member), member))
+
+            floor = self.entries[0] if self.entries else None
+            if self.complete or (floor is not None and (score, member) > floor):
+                bisect.insort(self.entries, (score, member))
+                self.members[member] = score
+                if len(self.entries) > self.capacity:
+                    _, dropped = self.entries.pop(0)
+                    del self.members[dropped]
+                    self.complete = False
+
+            # the users below the head are unknown to us; we cannot refill the head without asking redis
+            if not self.complete and len(self.entries) < self.top_n:
+                self.loaded_at = None
+
+    def get_top_players(self, top_n=None) -> List[int]:
+        top_n = top_n or self.top_n
+        with self.lock:
+            if top_n > self.capacity:
+                raise ValueError(f'top_n ({top_n}) is larger than the cache capacity ({self.capacity})')
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_staleness_s:
+                self.reload()
+            else:
+                self.hits += 1
+            return [int(member) for _, member in self.entries[:-top_n - 1:-1]]
+
+
+def get_user_rank(rclient, user_id: int, num_shards=NUM_SHARDS):
+    '''
+    With one shard this is a single ZREVRANK. With several shards it takes two round trips: a ZSCORE on the shard
+    of the user, then one pipeline counting the higher and tied scores on every shard. A Lua script could do both
+    in one call, but it would have to touch all the shard keys, which cannot work once they live on different nodes.
+    '''
+    if num_shards == 1:
+        return rclient.zrevrank(LEADERBOARD_KEY, user_id)
+
+    score = rclient.zscore(get_leaderboard_key(user_id, num_shards), user_id)
+    if score is None:
+        return None
+
+    # ZREVRANK puts users with a higher score first, and breaks ties by member string in descending order
+    pipe = rclient.pipeline(transaction=False)
+    for key in get_leaderboard_keys(num_shards):
+        pipe.zcount(key, f'({score}', '+inf')
+        pipe.zrangebyscore(key, score, score)
+    results = pipe.execute()
+
+    rank = 0
+    member = str(user_id)
+    for higher_count, tied_members in zip(results[0::2], results[1::2]):
+        rank += higher_count
+        rank += sum(1 for tied in tied_members if str(tied) > member)
+    return rank
+
+
+def get_higher_and_total_approx(rclient, score: float, num_shards=NUM_SHARDS):
+    '''
+    Estimate the number of users with a higher score than score, from the histograms of all shards alone.
+
+    All the buckets above the bucket of score are counted exactly; inside its own bucket we assume the scores are
+    spread evenly. So the estimate is never off by more than the number of users in that one bucket, which is
+    about num_users * SCORE_BUCKET_WIDTH / score range when the scores are spread evenly.
+    '''
+    pipe = rclient.pipeline(transaction=False)
+    for key in get_histogram_keys(num_shards):
+        pipe.hgetall(key)
+    histogram = {}
+    for shard_histogram in pipe.execute():
+        for raw_bucket, raw_count in shard_histogram.items():
+            histogram[int(raw_bucket)] = histogram.get(int(raw_bucket), 0) + int(raw_count)
+    bucket = int(score // SCORE_BUCKET_WIDTH)
+
+    higher = 0
+    total = 0
+    for other_bucket, count in histogram.items():
+        total += count
+        if other_bucket > bucket:
+            higher += count
+        elif other_bucket == bucket:
+            bucket_top = (bucket + 1) * SCORE_BUCKET_WIDTH
+            higher += count * (bucket_top - score) / SCORE_BUCKET_WIDTH
+    return higher, total
+
+
+def get_user_rank_approx(rclient, user_id: int, num_shards=NUM_SHARDS):
+    '''
+    Approximate version of get_user_rank(); see get_higher_and_total_approx() for the error bound. None when the
+    user has no score, or when there is no histogram to estimate from (the scores were written without histogram).
+    '''
+    score = rclient.zscore(get_leaderboard_key(user_id, num_shards), user_id)
+    if score is None:
+        return None
+
+    higher, total = get_higher_and_total_approx(rclient, score, num_shards)
+    if total == 0:
+        return None
+    return int(higher)
+
+
+def get_user_percentile_approx(rclient, user_id: int, num_shards=NUM_SHARDS):
+    '''
+    Approximate fraction of users ranked above the user, e.g. 0.03 for a user in the top 3%; None in the same cases
+    as get_user_rank_approx().
+    '''
+    score = rclient.zscore(get_leaderboard_key(user_id, num_shards), user_id)
+    if score is None:
+        return None
+
+    higher, total = get_higher_and_total_approx(rclient, score, num_shards)
+    if total == 0:
+        return None
+    return higher / total
+
+
+def benchmark_ingestion(num_scores=20_000):
+    '''
+    Compare per-message ZADD with batched ZADD, consuming the same pre-filled queue.
+    '''
+    random.seed(1)
+    rl = redis.Redis(host='localhost', port=6379, decode_responses=True)
+    msgs = [[random.randint(0, NUM_PLAYERS-1), random.randint(0, 10000)] for _ in range(num_scores)]
+
+    for name, batch_size in (('per-message', 1), (f'batched ({BATCH_SIZE})', BATCH_SIZE)):
+        rl.delete(LEADERBOARD_KEY, get_histogram_key(LEADERBOARD_KEY))
+        que = Queue()
+        for msg in msgs:
+            que.put(msg)
+        # give the queue feeder thread a moment to flush to the pipe so we only time the consumer
+        time.sleep(1)
+
+        start = time.perf_counter()
+        consumed = 0
+        while consumed < num_scores:
+            if batch_size == 1:
+                user_id, score = que.get(block=True)
+                receive_user_new_score(rl, user_id, score)
+                consumed += 1
+            else:
+                batch = drain_queue(que, batch_size, BATCH_TIMEOUT_MS)
+                receive_user_new_scores(rl, batch)
+                consumed += len(batch)
+        elapsed = time.perf_counter() - start
+        logging.info(f'BENCHMARK {name}: {num_scores} scores in {elapsed:.3f}s, {num_scores / elapsed:.0f} scores/sec')
+
+
+def benchmark_top_players(num_reads=20_000):
+    '''
+    Compare reading the top players from redis on every call with reading them from the local cache.
+    '''
+    random.seed(1)
+    rl = redis.Redis(host='localhost', port=6379, decode_responses=True)
+    rl.delete(LEADERBOARD_KEY, get_histogram_key(LEADERBOARD_KEY))
+    receive_user_new_scores(rl, [[user_id, random.randint(0, 10000)] for user_id in range(NUM_PLAYERS)])
+
+    cache = TopPlayersCache(rl, top_n=10)
+    for name, read_cache in (('redis', None), ('local cache', cache)):
+        start = time.perf_counter()
+        for i in range(num_reads):
+            # one new score every 10 reads, fed through the cache when there is one
+            if i % 10 == 0:
+                receive_user_new_score(rl, random.randint(0, NUM_PLAYERS-1), random.randint(0, 10000), read_cache)
+            get_top_players(rl, top_n=10, cache=read_cache)
+        elapsed = time.perf_counter() - start
+        logging.info(f'BENCHMARK top players from {name}: {num_reads / elapsed:.0f} reads/sec')
+
+    logging.info(f'BENCHMARK cache hits: {cache.hits}, reloads: {cache.reloads}')
+    if cache.get_top_players(10) != get_top_players(rl, top_n=10):
+        logging.warning('BENCHMARK cached top players do not match redis')
+
+
+def benchmark_shards(num_players=100_000, num_queries=2_000, shard_counts=(1, 2, 4, 8, 16)):
+    '''
+    Latency of get_user_rank and get_top_players against the number of shards, checking that every shard count
+    returns the same answers as the single key leaderboard.
+    '''
+    random.seed(1)
+    rl = redis.Redis(host='localhost', port=6379, decode_responses=True)
+    msgs = [[user_id, random.randint(0, 1000_000)] for user_id in range(num_players)]
+    query_users = [random.randint(0, num_players-1) for _ in range(num_queries)]
+
+    expected_ranks = None
+    expected_top = None
+    for num_shards in shard_counts:
+        keys = get_leaderboard_keys(num_shards) + get_histogram_keys(num_shards)
+        rl.delete(*keys)
+        for i in range(0, num_players, 10_000):
+            receive_user_new_scores(rl, msgs[i:i + 10_000], num_shards=num_shards)
+
+        start = time.perf_counter()
+        ranks = [get_user_rank(rl, user_id, num_shards=num_shards) for user_id in query_users]
+        rank_latency_ms = (time.perf_counter() - start) * 1000 / num_queries
+
+        start = time.perf_counter()
+        for _ in range(num_queries):
+            top = get_top_players(rl, top_n=10, num_shards=num_shards)
+        top_latency_ms = (time.perf_counter() - start) * 1000 / num_queries
+
+        if expected_ranks is None:
+            expected_ranks, expected_top = ranks, top
+        elif ranks != expected_ranks or top != expected_top:
+            logging.warning(f'BENCHMARK {num_shards} shards do not match the single key leaderboard')
+
+        logging.info(f'BENCHMARK {num_shards:2} shards: get_user_rank {rank_latency_ms:.3f} ms, '
+                     f'get_top_players {top_latency_ms:.3f} ms')
+        rl.delete(*keys)
+
+
+def benchmark_windows(num_players=50_000, num_scores=200_000, num_queries=2_000, window='hourly'):
+    '''
+    Measure the rollup rebuild cost when a bucket closes, and compare window queries with all-time queries.
+    The scores are spread over two windows of synthetic time, so every bucket gets closed at least once.
+    '''
+    random.seed(1)
+    rl = redis.Redis(host='localhost', port=6379, decode_responses=True)
+    for key in rl.scan_iter(f'{LEADERBOARD_KEY}*'):
+        rl.delete(key)
+    built_window_rollups.clear()
+
+    bucket_s, num_buckets = WINDOWS[window]
+    start_time = get_window_bucket_start(window)
+    time_step = bucket_s * num_buckets * 2 / num_scores
+    rebuild_times = []
+    for i in range(0, num_scores, BATCH_SIZE):
+        now = start_time + i * time_step
+        elapsed = ensure_window_rollup(rl, window, now)
+        if elapsed is not None:
+            rebuild_times.append(elapsed)
+        msgs = [[random.randint(0, num_players-1), random.randint(0, 10000)] for _ in range(BATCH_SIZE)]
+        receive_user_new_scores(rl, msgs, windowed=True, now=now)
+
+    logging.info(f'BENCHMARK {len(rebuild_times)} {window} rollup rebuilds, '
+                 f'avg {sum(rebuild_times) / len(rebuild_times) * 1000:.2f} ms, max {max(rebuild_times) * 1000:.2f} ms')
+
+    query_users = [random.randint(0, num_players-1) for _ in range(num_queries)]
+    for name, get_rank, get_top in (
+            ('all-time', lambda u: get_user_rank(rl, u), lambda: get_top_players(rl, top_n=10)),
+            (window, lambda u: get_user_window_rank(rl, window, u, now), lambda: get_window_top_players(rl, window, 10, now))):
+        start = time.perf_counter()
+        for user_id in query_users:
+            get_rank(user_id)
+            get_top()
+        elapsed = time.perf_counter() - start
+        logging.info(f'BENCHMARK {name} queries: {elapsed * 1000 / num_queries:.3f} ms per rank + top players')
+
+
+BENCHMARKS = {
+    'ingestion': benchmark_ingestion,
+    'top_players': benchmark_top_players,
+    'shards': benchmark_shards,
+    'windows': benchmark_windows,
+}
 
 
 if __name__ == "__main__":
-    main()
+    # python3 challenge_leaderboard.py benchmark [name ...]
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        for name in (sys.argv[2:] or BENCHMARKS.keys()):
+            BENCHMARKS[name]()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'histogram':
+        main(histogram=True)
+    else:
+        main()
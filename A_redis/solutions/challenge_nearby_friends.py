@@ -18,11 +18,15 @@ INFO:root:MAIN: verify location of user 00000 ...
 INFO:root:User 00000's location is verified successfully with friend 00001
 INFO:root:User 00000's location is verified successfully with friend 00002
 """
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 import logging
 import time
 import random 
 import pickle
+import math
+import sys
+import struct
+import collections
 
 import threading
 from multiprocessing import Process
@@ -31,6 +35,33 @@ import redis
 
 NUM_PROCESSES = 3
 
+# with MULTIPLEXED_SUBSCRIBER, a worker uses one pubsub connection and one dispatcher thread for all its users,
+# instead of one of each per user; the writes share a pool of at most WORKER_MAX_CONNECTIONS connections
+MULTIPLEXED_SUBSCRIBER = True
+WORKER_MAX_CONNECTIONS = 10
+
+# publish_user_location() keeps the latest location of every user in the LOCATIONS_GEO_KEY geo index; a friend's
+# new location is only pushed to the users within NEARBY_RADIUS_KM of it (None pushes it to all the friends)
+LOCATIONS_GEO_KEY = 'user_locations'
+NEARBY_RADIUS_KM = 500
+# the same earth radius as redis uses for GEODIST/GEOSEARCH
+EARTH_RADIUS_KM = 6372.7975608
+
+# the encoding of (lat, lng, timestamp) in pubsub messages and in the friends locations hashes; one of
+# LOCATION_CODECS. Note 'float32' rounds lat/lng to about 1 meter, so main() would report mismatches with it.
+LOCATION_CODEC = 'float64'
+
+# LocationPublishCoalescer publishes a user's location at most once per COALESCE_TICK_S; the updates in between
+# are dropped except the latest one, which is published at the end of the tick
+COALESCE_TICK_S = 0.5
+
+# with FANOUT_BUFFER, the multiplexed subscriber buffers the friend location writes and a flush writes them all in
+# one pipeline, once FANOUT_FLUSH_SIZE writes are pending or every FANOUT_FLUSH_INTERVAL_MS
+FANOUT_BUFFER = True
+FANOUT_FLUSH_SIZE = 200
+FANOUT_FLUSH_INTERVAL_MS = 5
+FANOUT_FLUSH_RETRIES = 3
+
 USER_LIST = [f"{i:05}" for i in range(10)]
 FRIENDS = {
     "00000": ["00001", "00002"],
@@ -53,10 +84,153 @@ def get_friends(user_id):
     return FRIENDS[user_id]
 
 
-def notify_user_about_friend_location(rclient, user_id, friend_id, lat: float, lng: float):
+class PickleLocationCodec():
+    def encode(self, lat: float, lng: float, timestamp: float) -> bytes:
+        return pickle.dumps((lat, lng, timestamp))
+
+    def decode(self, data: bytes) -> Tuple[float, float, float]:
+        return pickle.loads(data)
+
+
+class StructLocationCodec():
+    '''
+    Fixed width little-endian encoding; lat_lng_type is 'd' (float64) or 'f' (float32), the timestamp is a float64
+    of seconds since epoch.
+    '''
+    def __init__(self, lat_lng_type: str):
+        self.packer = struct.Struct(f'<{lat_lng_type}{lat_lng_type}d')
+
+    def encode(self, lat: float, lng: float, timestamp: float) -> bytes:
+        return self.packer.pack(lat, lng, timestamp)
+
+    def decode(self, data: bytes) -> Tuple[float, float, float]:
+        return self.packer.unpack(data)
+
+
+LOCATION_CODECS = {
+    'pickle': PickleLocationCodec(),
+    'float64': StructLocationCodec('d'),
+    'float32': StructLocationCodec('f'),
+}
+
+
+def encode_location(lat: float, lng: float, timestamp: Optional[float] = None) -> bytes:
+    return LOCATION_CODECS[LOCATION_CODEC].encode(lat, lng, time.time() if timestamp is None else timestamp)
+
+
+def decode_location(data: bytes) -> Tuple[float, float, float]:
+    return LOCATION_CODECS[LOCATION_CODEC].decode(data)
+
+
+def notify_user_about_friend_location(rclient, user_id, friend_id, lat: float, lng: float,
+                                      timestamp: Optional[float] = None):
     # if we have a websocket, we would use the WebSocket to send the friend's new location to the user immediately;
     # however, here we simply write the friend's new location to redis for this user.
-    rclient.hset(f'{user_id}_friends_locations', key=friend_id, value=pickle.dumps((lat, lng)))
+    rclient.hset(f'{user_id}_friends_locations', key=friend_id, value=encode_location(lat, lng, timestamp))
+
+
+def forget_friend_location(rclient, user_id, friend_id):
+    # the friend moved out of the radius, so the last location we have is no longer a nearby one
+    rclient.hdel(f'{user_id}_friends_locations', friend_id)
+
+
+class FriendLocationWriteBuffer():
+    '''
+    Collect notify_user_about_friend_location() writes and flush them in one pipeline.
+
+    Only the latest location of a (user, friend) pair is kept, or its removal once the friend is out of the radius,
+    and one flush runs at a time, so the writes of a key land in order. HSET and HDEL are idempotent, so a failed
+    flush is simply retried; if it keeps failing, the batch goes back to the buffer unless a newer update of the same
+    pair came in meanwhile.
+    '''
+    def __init__(self, rclient, max_batch=FANOUT_FLUSH_SIZE, flush_interval_ms=FANOUT_FLUSH_INTERVAL_MS,
+                 max_retries=FANOUT_FLUSH_RETRIES):
+        self.rclient = rclient
+        self.max_batch = max_batch
+        self.flush_interval_ms = flush_interval_ms
+        self.max_retries = max_retries
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}       # (user id, friend id) -> (lat, lng, timestamp), or None to remove the friend
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.written = 0
+        # seconds from the location timestamp to the end of the flush which wrote it
+        self.freshness = collections.deque(maxlen=100_000)
+
+    def add(self, user_id, friend_id, lat: float, lng: float, timestamp: Optional[float] = None):
+        with self.lock:
+            self.pending[(user_id, friend_id)] = (lat, lng, time.time() if timestamp is None else timestamp)
+            is_full = len(self.pending) >= self.max_batch
+        if is_full:
+            self.flush()
+
+    def remove(self, user_id, friend_id):
+        with self.lock:
+            self.pending[(user_id, friend_id)] = None
+            is_full = len(self.pending) >= self.max_batch
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return
+
+            mappings = {}
+            removals = {}
+            for (user_id, friend_id), location in batch.items():
+                key = f'{user_id}_friends_locations'
+                if location is None:
+                    removals.setdefault(key, []).append(friend_id)
+                else:
+                    mappings.setdefault(key, {})[friend_id] = encode_location(*location)
+
+            for attempt in range(self.max_retries + 1):
+                try:
+                    pipe = self.rclient.pipeline(transaction=False)
+                    for key, mapping in mappings.items():
+                        pipe.hset(key, mapping=mapping)
+                    for key, friend_ids in removals.items():
+                        pipe.hdel(key, *friend_ids)
+                    pipe.execute()
+                    break
+                except redis.exceptions.RedisError as e:
+                    if attempt < self.max_retries:
+                        time.sleep(0.01 * 2 ** attempt)
+                        continue
+                    logging.warning(f'Failed to flush {len(batch)} friend locations, keep them for next flush: {e}')
+                    with self.lock:
+                        for pair, location in batch.items():
+                            self.pending.setdefault(pair, location)
+                    return
+
+            flushed_at = time.time()
+            self.written += len(batch)
+            self.freshness.extend(flushed_at - location[2] for location in batch.values() if location is not None)
+
+    def start(self) -> threading.Thread:
+        def run():
+            while not self.stopped.wait(self.flush_interval_ms / 1000):
+                # a failed flush must not end the thread, or no friend location would be written any more
+                try:
+                    self.flush()
+                except Exception:
+                    logging.exception('Failed to flush friend locations')
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
 
 
 def get_user_nearby_friend_locations(rclient, user_id) -> Dict[str, Tuple[float, float]]:
@@ -64,7 +238,8 @@ def get_user_nearby_friend_locations(rclient, user_id) -> Dict[str, Tuple[float,
     raw_friends_locations = rclient.hgetall(f'{user_id}_friends_locations')
     friends_locations = {}
     for k, v in raw_friends_locations.items():
-        friends_locations[k.decode('utf-8')] = pickle.loads(v)
+        lat, lng, _ = decode_location(v)
+        friends_locations[k.decode('utf-8')] = (lat, lng)
     return friends_locations
 
 
@@ -75,10 +250,25 @@ def worker_process(process_id, responsible_users: List[str]):
     Note multi workers will be started. Each worker is responsible for a group of users.
     '''
     # rl = redis.Redis(host='localhost', port=6379, decode_responses=True)
-    rclient = redis.Redis(host='localhost', port=6379)
-    
-    for user_id in responsible_users:
-        subscribe_friends_update(rclient, user_id)
+    if MULTIPLEXED_SUBSCRIBER:
+        # the dispatcher thread and the main thread of the worker share the pool; it blocks when all connections
+        # are in use instead of opening more
+        pool = redis.BlockingConnectionPool(host='localhost', port=6379, max_connections=WORKER_MAX_CONNECTIONS)
+        rclient = redis.Redis(connection_pool=pool)
+
+        write_buffer = None
+        if FANOUT_BUFFER:
+            write_buffer = FriendLocationWriteBuffer(rclient)
+            write_buffer.start()
+
+        subscriber = FriendsUpdateSubscriber(rclient, write_buffer=write_buffer)
+        for user_id in responsible_users:
+            subscribe_friends_update(rclient, user_id, subscriber=subscriber)
+        subscriber.start()
+    else:
+        rclient = redis.Redis(host='localhost', port=6379)
+        for user_id in responsible_users:
+            subscribe_friends_update(rclient, user_id)
 
     # Wait for messages from the message handler, and also publish messages occasionally
     while True:
@@ -92,6 +282,7 @@ def main():
     rclient = redis.Redis(host='localhost', port=6379)
     for user_id in USER_LIST:
         rclient.delete(f'{user_id}_friends_locations')
+    rclient.delete(LOCATIONS_GEO_KEY)
 
     # start a few worker processes
     logging.info('Starting processes...')
@@ -110,11 +301,18 @@ def main():
     # Send some random user location updates
     logging.info('MAIN: Starting send user update ...')
     user_last_location = {}
+    # user id -> the friends who were nearby when the user published the last location
+    user_last_nearby_friends = {}
     random.seed(1)
     for i in range(1000):
         user_id = random.choice(USER_LIST)
         location = (random.uniform(0, 10), random.uniform(0, 10))
         user_last_location[user_id] = location
+        user_last_nearby_friends[user_id] = set(
+            friend_id for friend_id in get_friends(user_id)
+            if friend_id in user_last_location and
+                (NEARBY_RADIUS_KM is None or
+                 distance_km(location, user_last_location[friend_id]) <= NEARBY_RADIUS_KM))
         publish_user_location(rclient, user_id, location[0], location[1])
 
         sleep_time = random.uniform(0, 1)
@@ -133,6 +331,10 @@ def main():
         # Fetch the location of this user from her/his friend side
         friends = get_friends(target_user_id)
         for friend_id in friends:
+            if friend_id not in user_last_nearby_friends[target_user_id]:
+                logging.info(f"Skip friend {friend_id}, who was not nearby when user {target_user_id} last moved")
+                continue
+
             user_friend_location = get_user_nearby_friend_locations(rclient, friend_id)
             if target_user_id not in user_friend_location:
                 logging.error(f"User {target_user_id}'s is not found at friend {friend_id} 's location cache")
@@ -162,11 +364,157 @@ def get_user_id_from_channel_name(channel_name: str):
     return channel_name[len("user-"):]
 
 
-def publish_user_location(rclient, user_id: str, lat: float, lng: float):
-    rclient.publish(get_user_channel_name(user_id), pickle.dumps((lat, lng)))
+def publish_user_location(rclient, user_id: str, lat: float, lng: float, timestamp: Optional[float] = None):
+    pipe = rclient.pipeline(transaction=False)
+    pipe.geoadd(LOCATIONS_GEO_KEY, [lng, lat, user_id])
+    pipe.publish(get_user_channel_name(user_id), encode_location(lat, lng, timestamp))
+    pipe.execute()
+
 
+class LocationPublishCoalescer():
+    '''
+    Sits in front of publish_user_location() and caps how often one user's location is published.
+
+    The first update of a user after a quiet tick is published right away; the following ones within the tick only
+    replace the pending location, which a background thread publishes when the tick is over. So the latest location
+    always gets out, at most tick_s late. The timestamp sent along is when the location was submitted.
+    '''
+    def __init__(self, rclient, tick_s=COALESCE_TICK_S, user_tick_s: Optional[Dict[str, float]] = None):
+        self.rclient = rclient
+        self.tick_s = tick_s
+        self.user_tick_s = dict(user_tick_s or {})    # user id -> tick overriding tick_s
+
+        self.lock = threading.Lock()
+        self.pending = {}               # user id -> (lat, lng, timestamp) waiting for the end of the tick
+        self.last_published_at = {}     # user id -> time.monotonic() of the last publish
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.submitted = 0
+        self.published = 0
+        self.suppressed = 0
+        self.user_suppressed = {}       # user id -> number of updates replaced by a later one
+
+    def set_user_tick(self, user_id: str, tick_s: float):
+        with self.lock:
+            self.user_tick_s[user_id] = tick_s
+
+    def submit(self, user_id: str, lat: float, lng: float):
+        now = time.monotonic()
+        with self.lock:
+            self.submitted += 1
+            tick_s = self.user_tick_s.get(user_id, self.tick_s)
+            last_published_at = self.last_published_at.get(user_id)
+            publish_now = user_id not in self.pending and \
+                (last_published_at is None or now - last_published_at >= tick_s)
+            if publish_now:
+                self.last_published_at[user_id] = now
+            else:
+                if user_id in self.pending:
+                    self.suppressed += 1
+                    self.user_suppressed[user_id] = self.user_suppressed.get(user_id, 0) + 1
+                self.pending[user_id] = (lat, lng, time.time())
+
+        if publish_now:
+            self.publish([(user_id, (lat, lng, time.time()))])
+
+    def publish(self, due: List):
+        '''
+        Publish the (user id, location) pairs of due in turn. When redis fails, the ones not published yet go back to
+        pending, unless a newer location of the same user came in meanwhile, and the next tick retries them.
+        '''
+        for i, (user_id, (lat, lng, timestamp)) in enumerate(due):
+            try:
+                publish_user_location(self.rclient, user_id, lat, lng, timestamp)
+            except redis.exceptions.RedisError as e:
+                logging.warning(f'Failed to publish {len(due) - i} locations, keep them for the next tick: {e}')
+                with self.lock:
+                    for user_id, location in due[i:]:
+                        self.pending.setdefault(user_id, location)
+                return
+            with self.lock:
+                self.published += 1
+
+    def flush(self, force=False):
+        '''
+        Publish the pending locations whose tick is over, or all of them with force.
+        '''
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            for user_id, location in list(self.pending.items()):
+                tick_s = self.user_tick_s.get(user_id, self.tick_s)
+                if force or now - self.last_published_at.get(user_id, now) >= tick_s:
+                    del self.pending[user_id]
+                    self.last_published_at[user_id] = now
+                    due.append((user_id, location))
+
+        self.publish(due)
+
+    def start(self) -> threading.Thread:
+        def run():
+            while not self.stopped.wait(self.tick_s / 10):
+                # like the fan-out flusher, a failed flush must not end the thread and strand the pending locations
+                try:
+                    self.flush()
+                except Exception:
+                    logging.exception('Failed to flush coalesced locations')
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.flush(force=True)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'submitted': self.submitted, 'published': self.published, 'suppressed': self.suppressed,
+                    'pending': len(self.pending)}
+
+
+def distance_km(location1: Tuple[float, float], location2: Tuple[float, float]) -> float:
+    # haversine distance between two (lat, lng)
+    lat1, lng1 = math.radians(location1[0]), math.radians(location1[1])
+    lat2, lng2 = math.radians(location2[0]), math.radians(location2[1])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def get_nearby_users(rclient, lat: float, lng: float, user_ids: List[str], radius_km=NEARBY_RADIUS_KM) -> List[str]:
+    '''
+    Keep the users of user_ids whose latest location in the geo index is within radius_km of (lat, lng).
+
+    We read the candidates' positions with one GEOPOS instead of a GEOSEARCH around (lat, lng): the cost then
+    grows with the number of friends, not with how crowded the neighborhood is.
+    '''
+    if radius_km is None:
+        return list(user_ids)
+    if not user_ids:
+        return []
+
+    user_ids = list(user_ids)
+    positions = rclient.geopos(LOCATIONS_GEO_KEY, *user_ids)
+    nearby_users = []
+    for user_id, position in zip(user_ids, positions):
+        # users who never shared a location are not near anybody
+        if position and distance_km((lat, lng), (position[1], position[0])) <= radius_km:
+            nearby_users.append(user_id)
+    return nearby_users
+
+
+def subscribe_friends_update(rclient, user_id: str, subscriber=None):
+    '''
+    Return the thread dispatching the user's updates, or with a subscriber, the subscriber itself: its thread only
+    exists once all the users are added and subscriber.start() has run.
+    '''
+    if subscriber:
+        subscriber.add_user(user_id)
+        return subscriber
 
-def subscribe_friends_update(rclient, user_id: str) -> threading.Thread:
     # define the handler for pubsub messages from other workers
     # this handler runs in a different thread and put message into the msg_que
     def handle_msg(msg):
@@ -174,8 +522,11 @@ def subscribe_friends_update(rclient, user_id: str) -> threading.Thread:
         nonlocal rclient
 
         friend_id = get_user_id_from_channel_name(msg['channel'])
-        location = pickle.loads(msg['data'])
-        notify_user_about_friend_location(rclient, user_id, friend_id, location[0], location[1])
+        lat, lng, timestamp = decode_location(msg['data'])
+        if not get_nearby_users(rclient, lat, lng, [user_id]):
+            forget_friend_location(rclient, user_id, friend_id)
+            return
+        notify_user_about_friend_location(rclient, user_id, friend_id, lat, lng, timestamp)
 
     # Register pubsub message handler for topics by other workers
     channels_handler_map = {}
@@ -192,5 +543,218 @@ def subscribe_friends_update(rclient, user_id: str) -> threading.Thread:
     return thread
 
 
+class FriendsUpdateSubscriber():
+    '''
+    Subscribe to the friends' channels of many users over one pubsub connection, and dispatch every message to
+    all the users following that channel from one thread.
+
+    Add all the users before start(); the channel -> users index is not meant to be changed while dispatching.
+    '''
+    def __init__(self, rclient, write_buffer=None):
+        self.rclient = rclient
+        self.write_buffer = write_buffer
+        self.pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+        self.channel_users = {}     # channel name -> set of user ids who are friends of the channel's user
+        self.thread = None
+
+    def add_user(self, user_id: str, friends: Optional[List[str]] = None):
+        new_channels = []
+        for friend_id in (get_friends(user_id) if friends is None else friends):
+            channel_name = get_user_channel_name(friend_id)
+            if channel_name not in self.channel_users:
+                self.channel_users[channel_name] = set()
+                new_channels.append(channel_name)
+            self.channel_users[channel_name].add(user_id)
+
+        if new_channels:
+            self.pubsub.subscribe(**{channel_name: self.handle_msg for channel_name in new_channels})
+        logging.info(f'subscribed channels: {new_channels} for {user_id}')
+
+    def handle_msg(self, msg):
+        channel_name = msg['channel'].decode('utf-8')
+        friend_id = get_user_id_from_channel_name(channel_name)
+        lat, lng, timestamp = decode_location(msg['data'])
+        users = self.channel_users.get(channel_name, ())
+        nearby_users = set(get_nearby_users(self.rclient, lat, lng, users))
+        for user_id in users:
+            if user_id in nearby_users:
+                if self.write_buffer:
+                    self.write_buffer.add(user_id, friend_id, lat, lng, timestamp)
+                else:
+                    notify_user_about_friend_location(self.rclient, user_id, friend_id, lat, lng, timestamp)
+            elif self.write_buffer:
+                self.write_buffer.remove(user_id, friend_id)
+            else:
+                forget_friend_location(self.rclient, user_id, friend_id)
+
+    def handle_exception(self, e, pubsub, thread):
+        # without a handler, the first failing message would stop the dispatching for every user of the worker;
+        # the short sleep keeps the thread from spinning while redis is unreachable
+        logging.warning(f'Failed to dispatch a friend location update: {e!r}')
+        time.sleep(0.1)
+
+    def start(self) -> threading.Thread:
+        self.thread = self.pubsub.run_in_thread(sleep_time=0.1, daemon=True, exception_handler=self.handle_exception)
+        return self.thread
+
+
+def benchmark_geo_fanout(num_users=20_000, num_friends=50, num_updates=20_000, radius_km=5):
+    '''
+    Count the friend location writes saved by the radius filter, for users spread over a 30km x 30km city.
+    '''
+    random.seed(1)
+    rclient = redis.Redis(host='localhost', port=6379)
+    rclient.delete(LOCATIONS_GEO_KEY)
+
+    users = [f'{i:05}' for i in range(num_users)]
+    locations = {user_id: (random.uniform(40.60, 40.87), random.uniform(-74.10, -73.75)) for user_id in users}
+    pipe = rclient.pipeline(transaction=False)
+    for user_id, (lat, lng) in locations.items():
+        pipe.geoadd(LOCATIONS_GEO_KEY, [lng, lat, user_id])
+    pipe.execute()
+    friends = {user_id: random.sample(users, num_friends) for user_id in users}
+
+    writes_all = 0
+    writes_nearby = 0
+    start = time.perf_counter()
+    for _ in range(num_updates):
+        user_id = random.choice(users)
+        lat, lng = locations[user_id]
+        lat, lng = lat + random.uniform(-0.001, 0.001), lng + random.uniform(-0.001, 0.001)
+        locations[user_id] = (lat, lng)
+
+        publish_user_location(rclient, user_id, lat, lng)
+        writes_all += len(friends[user_id])
+        writes_nearby += len(get_nearby_users(rclient, lat, lng, friends[user_id], radius_km))
+    elapsed = time.perf_counter() - start
+
+    logging.info(f'BENCHMARK {num_updates} updates: {writes_all} fan-out writes without filter, {writes_nearby} '
+                 f'within {radius_km}km ({(1 - writes_nearby / writes_all) * 100:.1f}% saved); '
+                 f'{num_updates / elapsed:.0f} updates/sec with publish and filter')
+    rclient.delete(LOCATIONS_GEO_KEY)
+
+
+def benchmark_codecs(num_locations=200_000):
+    '''
+    Encode/decode throughput and bytes per message of every location codec; no redis needed.
+    '''
+    random.seed(1)
+    locations = [(random.uniform(-90, 90), random.uniform(-180, 180), time.time()) for _ in range(num_locations)]
+
+    for name, codec in LOCATION_CODECS.items():
+        start = time.perf_counter()
+        encoded = [codec.encode(lat, lng, timestamp) for lat, lng, timestamp in locations]
+        encode_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for data in encoded:
+            codec.decode(data)
+        decode_elapsed = time.perf_counter() - start
+
+        logging.info(f'BENCHMARK {name:8}: {len(encoded[0])} bytes/message, '
+                     f'encode {num_locations / encode_elapsed:.0f}/sec, decode {num_locations / decode_elapsed:.0f}/sec')
+
+
+def benchmark_coalescer(num_users=200, updates_per_s=20, duration_s=5, tick_s=COALESCE_TICK_S):
+    '''
+    num_users clients each send updates_per_s locations for duration_s; count the publishes the coalescer saves and
+    check that every user's latest location still reaches the geo index.
+    '''
+    random.seed(1)
+    rclient = redis.Redis(host='localhost', port=6379)
+    rclient.delete(LOCATIONS_GEO_KEY)
+
+    users = [f'{i:05}' for i in range(num_users)]
+    last_locations = {}
+    coalescer = LocationPublishCoalescer(rclient, tick_s=tick_s)
+    # a slow-moving user can be held back longer
+    coalescer.set_user_tick(users[0], tick_s * 4)
+    coalescer.start()
+
+    start = time.perf_counter()
+    for _ in range(int(updates_per_s * duration_s)):
+        round_start = time.perf_counter()
+        for user_id in users:
+            location = (random.uniform(40.60, 40.87), random.uniform(-74.10, -73.75))
+            last_locations[user_id] = location
+            coalescer.submit(user_id, location[0], location[1])
+        time.sleep(max(0.0, 1 / updates_per_s - (time.perf_counter() - round_start)))
+    coalescer.stop()
+    elapsed = time.perf_counter() - start
+
+    stats = coalescer.stats()
+    logging.info(f'BENCHMARK {stats["submitted"]} updates in {elapsed:.1f}s: {stats["published"]} published, '
+                 f'{stats["suppressed"]} suppressed ({stats["published"] / stats["submitted"] * 100:.1f}% of the '
+                 f'redis writes left), {coalescer.user_suppressed.get(users[0], 0)} suppressed for {users[0]}')
+
+    positions = rclient.geopos(LOCATIONS_GEO_KEY, *users)
+    lost = sum(1 for user_id, position in zip(users, positions)
+               if distance_km(last_locations[user_id], (position[1], position[0])) > 0.001)
+    if lost:
+        logging.warning(f'BENCHMARK {lost} users do not have their latest location in the geo index')
+    rclient.delete(LOCATIONS_GEO_KEY)
+
+
+def benchmark_fanout_buffer(num_users=500, num_friends=50, updates_per_s=200, duration_s=5):
+    '''
+    Write throughput and p50/p99 location freshness (publish to HSET done) of the fan-out, one write per round trip
+    (max_batch=1) against the buffered pipeline flushes. The subscriber runs in this process.
+    '''
+    random.seed(1)
+    rclient = redis.Redis(host='localhost', port=6379)
+    users = [f'{i:05}' for i in range(num_users)]
+    friends = {user_id: random.sample(users, num_friends) for user_id in users}
+
+    rclient.delete(LOCATIONS_GEO_KEY)
+    for user_id in users:
+        rclient.delete(f'{user_id}_friends_locations')
+    pipe = rclient.pipeline(transaction=False)
+    for user_id in users:
+        pipe.geoadd(LOCATIONS_GEO_KEY, [random.uniform(-74.10, -73.75), random.uniform(40.60, 40.87), user_id])
+    pipe.execute()
+
+    for name, max_batch in (('per-write', 1), (f'buffered ({FANOUT_FLUSH_SIZE})', FANOUT_FLUSH_SIZE)):
+        write_buffer = FriendLocationWriteBuffer(rclient, max_batch=max_batch)
+        write_buffer.start()
+        subscriber = FriendsUpdateSubscriber(rclient, write_buffer=write_buffer)
+        for user_id in users:
+            subscriber.add_user(user_id, friends[user_id])
+        subscriber.start()
+        time.sleep(1)
+
+        start = time.perf_counter()
+        for _ in range(int(updates_per_s * duration_s)):
+            publish_user_location(rclient, random.choice(users),
+                                  random.uniform(40.60, 40.87), random.uniform(-74.10, -73.75))
+            time.sleep(1 / updates_per_s)
+        # let the subscriber drain the published messages
+        time.sleep(1)
+        subscriber.thread.stop()
+        write_buffer.stop()
+        elapsed = time.perf_counter() - start
+
+        freshness_ms = sorted(f * 1000 for f in write_buffer.freshness)
+        p50 = freshness_ms[len(freshness_ms) // 2]
+        p99 = freshness_ms[int(len(freshness_ms) * 0.99)]
+        logging.info(f'BENCHMARK {name}: {write_buffer.written} writes, {write_buffer.written / elapsed:.0f} writes/sec, '
+                     f'freshness p50 {p50:.1f} ms, p99 {p99:.1f} ms')
+        subscriber.pubsub.close()
+
+    rclient.delete(LOCATIONS_GEO_KEY)
+
+
+BENCHMARKS = {
+    'geo_fanout': benchmark_geo_fanout,
+    'codecs': benchmark_codecs,
+    'coalescer': benchmark_coalescer,
+    'fanout_buffer': benchmark_fanout_buffer,
+}
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # python3 challenge_nearby_friends.py benchmark [name ...]
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        for name in (sys.argv[2:] or BENCHMARKS.keys()):
+            BENCHMARKS[name]()
+    else:
+        main()
\ No newline at end of file
@@ -1,11 +1,19 @@
-from typing import Optional
+from typing import Optional, List, Dict, Iterator
 import os 
+import re
+import sys
+import time
+import random
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dateutil import parser
 from datetime import datetime
 
 import boto3
 import botocore
+from boto3.dynamodb.types import TypeSerializer
+from boto3.dynamodb.conditions import Key, Attr
 import pandas as pd
 
 
@@ -13,17 +21,58 @@ logging.basicConfig(level=logging.INFO)
 
 
 TABLE_NAME = 'ecommerce'
-CSV_FILE_LOCATION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+CSV_FILE_LOCATION = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
                                  'data', 'ecommerce.csv')
 
-ddb = boto3.resource('dynamodb', endpoint_url='http://localhost:8000')
+# An order date matching one of these patterns is parsed with its format: dates with slashes are month first and dates
+# with dashes are day first, like the ones in the CSV. Only the dates matching none of them go through dateutil.
+# Both loaders use these, see parse_order_date(); bulk_write_table() applies them column-wise.
+ORDER_DATE_FORMATS = {
+    r'^\d{1,2}/\d{1,2}/\d{4}$': '%m/%d/%Y',   # 8/8/2022
+    r'^\d{1,2}-\d{1,2}-\d{4}$': '%d-%m-%Y',   # 21-01-2022
+}
+
+# bulk_write_table() writes the items with BULK_WRITERS threads, each sending BatchWriteItem requests of
+# BATCH_WRITE_SIZE items (the DynamoDB maximum) and resending the unprocessed items up to BATCH_WRITE_MAX_ATTEMPTS times
+BULK_WRITERS = 8
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_ATTEMPTS = 8
+BATCH_WRITE_BACKOFF_S = 0.05
+
+# the attributes the order queries read by default; every query page reports the read units it consumed, so a
+# narrower projection can be checked against it
+ORDER_PROJECTION = 'order_date_plus_order_id, product_name, order_date'
+
+# the local secondary index of the orders of a customer by product name, for product name prefix queries; it projects
+# order_date too, so ORDER_PROJECTION is served from the index alone
+PRODUCT_NAME_INDEX = 'product_name'
+
+# With WRITE_PRODUCT_TOKENS, bulk_write_table() also writes an inverted index of the product names into
+# PRODUCT_TOKEN_TABLE_NAME: one item per order and lower-cased word of its product name, keyed by customer_id#word,
+# so query_customer_orders_by_words() finds orders by word with queries instead of filtering all orders.
+WRITE_PRODUCT_TOKENS = False
+PRODUCT_TOKEN_TABLE_NAME = 'ecommerce_product_tokens'
+
+# query_customers_orders() queries the orders of many customers on CUSTOMER_QUERY_WORKERS threads
+CUSTOMER_QUERY_WORKERS = 16
+
+DYNAMODB_ENDPOINT_URL = 'http://localhost:8000'
+ddb = boto3.resource('dynamodb', endpoint_url=DYNAMODB_ENDPOINT_URL)
 table_obj = None
+# boto3 sessions and resources are not thread safe; every query worker thread gets its own, see get_thread_table()
+thread_local = threading.local()
+# max_workers -> the executor of query_customers_orders(); it outlives the calls, so its threads keep their sessions
+customer_query_executors = {}
+customer_query_executors_lock = threading.Lock()
  
 
 def main():
     delete_table()
     create_table()
-    batch_write_table()
+    if WRITE_PRODUCT_TOKENS:
+        delete_table(PRODUCT_TOKEN_TABLE_NAME)
+        create_token_table()
+    bulk_write_table()
 
     customer_id = 'C_ID_36240'
     # this customer has 6 orders, with dates of:
@@ -42,9 +91,18 @@ def main():
     logging.info(f"User {customer_id}'s order with the word '{product_name_substr}' in product name")
     get_customer_orders(customer_id, product_name_substr=product_name_substr)
 
+    product_name_prefix = 'Ooma'
+    logging.info(f"User {customer_id}'s order with product name starting with '{product_name_prefix}'")
+    get_customer_orders(customer_id, product_name_prefix=product_name_prefix)
+
+    if WRITE_PRODUCT_TOKENS:
+        logging.info(f"User {customer_id}'s order with the word 'phone' in product name, from the token table")
+        for order in query_customer_orders_by_words(customer_id, ['phone']):
+            logging.info(f' - order: {order}')
 
-def delete_table():
-    table_obj = ddb.Table(TABLE_NAME)
+
+def delete_table(table_name=TABLE_NAME):
+    table_obj = ddb.Table(table_name)
     try:
         table_obj.load()
     except botocore.exceptions.ClientError:
@@ -72,7 +130,7 @@ def create_table():
                 {'AttributeName': 'customer_id', 'KeyType': 'HASH'},
                 {'AttributeName': 'product_name', 'KeyType': 'RANGE'},
             ],
-            'Projection': { 'ProjectionType': 'KEYS_ONLY' }
+            'Projection': { 'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['order_date'] }
         },
     ]
     ProvisionedThroughput = {'ReadCapacityUnits': 10, 'WriteCapacityUnits': 10}
@@ -83,6 +141,24 @@ def create_table():
                                 LocalSecondaryIndexes=LocalSecondaryIndexes,
                                 ProvisionedThroughput=ProvisionedThroughput)
     table_obj.wait_until_exists()
+
+
+def create_token_table():
+    AttributeDefinitions = [
+        { 'AttributeName': 'customer_token', 'AttributeType': 'S'},
+        { 'AttributeName': 'order_date_plus_order_id', 'AttributeType': 'S'},
+    ]
+    KeySchema=[
+        {'AttributeName': 'customer_token', 'KeyType': 'HASH'},
+        {'AttributeName': 'order_date_plus_order_id', 'KeyType': 'RANGE'},
+    ]
+    ProvisionedThroughput = {'ReadCapacityUnits': 10, 'WriteCapacityUnits': 10}
+
+    token_table_obj = ddb.create_table(TableName=PRODUCT_TOKEN_TABLE_NAME,
+                                      AttributeDefinitions=AttributeDefinitions,
+                                      KeySchema=KeySchema,
+                                      ProvisionedThroughput=ProvisionedThroughput)
+    token_table_obj.wait_until_exists()
             
 
 def get_table():
@@ -90,8 +166,28 @@ def get_table():
     return table_obj
 
 
-def batch_write_table():
-    df = pd.read_csv(CSV_FILE_LOCATION)
+def get_thread_table():
+    '''
+    The orders table through a boto3 session of the current thread, created on first use; a worker thread keeps
+    reusing it (and its HTTP connections) for all its queries.
+    '''
+    if not hasattr(thread_local, 'table'):
+        session = boto3.session.Session()
+        thread_local.table = session.resource('dynamodb', endpoint_url=DYNAMODB_ENDPOINT_URL).Table(TABLE_NAME)
+    return thread_local.table
+
+
+def get_customer_query_executor(max_workers: int) -> ThreadPoolExecutor:
+    with customer_query_executors_lock:
+        if max_workers not in customer_query_executors:
+            customer_query_executors[max_workers] = ThreadPoolExecutor(max_workers=max_workers,
+                                                                        thread_name_prefix='customer_query')
+        return customer_query_executors[max_workers]
+
+
+def batch_write_table(df: Optional[pd.DataFrame] = None) -> int:
+    if df is None:
+        df = pd.read_csv(CSV_FILE_LOCATION)
     
     # selected_df = df.sample(n=100)
     added_order_id = set()
@@ -107,15 +203,134 @@ def batch_write_table():
                 added_order_id.add(row.get('order_id', ''))
 
     logging.info(f'Completed writing records; total record: {df.shape[0]}; written orders: {len(added_order_id)}')
+    return len(added_order_id)
 
 
-def create_order_item(customer_id, order_id, product_name, order_date):
+def parse_order_date(order_date: str) -> Optional[datetime]:
+    '''
+    Parse one order date with the format of the first ORDER_DATE_FORMATS pattern it matches, so 01-02-2022 is the 1st
+    of February like in parse_order_dates(), or else with dateutil; None when it cannot be parsed.
+    '''
+    for pattern, date_format in ORDER_DATE_FORMATS.items():
+        if re.match(pattern, order_date):
+            try:
+                return datetime.strptime(order_date, date_format)
+            except ValueError:
+                return None
     try:
-        parsed_order_date = parser.parse(order_date)
-        order_date_formatted_str = parsed_order_date.strftime("%Y-%m-%d")
-    except parser.ParserError as e:
+        return parser.parse(order_date)
+    except (parser.ParserError, OverflowError):
+        return None
+
+
+def parse_order_dates(order_dates: pd.Series) -> pd.Series:
+    '''
+    Parse a column of order date strings like parse_order_date() does; NaT for the ones that cannot be parsed.
+    '''
+    parsed = pd.Series(pd.NaT, index=order_dates.index, dtype='datetime64[ns]')
+    unmatched = pd.Series(True, index=order_dates.index)
+    for pattern, date_format in ORDER_DATE_FORMATS.items():
+        matched = unmatched & order_dates.str.match(pattern, na=False)
+        parsed[matched] = pd.to_datetime(order_dates[matched], format=date_format, errors='coerce')
+        unmatched &= ~matched
+
+    if unmatched.any():
+        formats = {order_date: parse_order_date(order_date) for order_date in order_dates[unmatched].unique()}
+        parsed[unmatched] = pd.to_datetime(order_dates[unmatched].map(formats))
+    return parsed
+
+
+def prepare_order_items(df: pd.DataFrame) -> List[Dict]:
+    '''
+    The items of create_order_item() for a whole data frame at once: the first row of every order ID, with the
+    sort key built by vectorized string operations; rows with an invalid order date are left out.
+    '''
+    df = df.drop_duplicates(subset='order_id', keep='first')
+    order_dates = parse_order_dates(df['order_date'])
+
+    invalid = order_dates.isna()
+    for order_id, order_date in df.loc[invalid, ['order_id', 'order_date']].itertuples(index=False):
+        logging.warning(f'Invalid order_date string "{order_date}" for order {order_id}')
+    df, order_dates = df[~invalid], order_dates[~invalid]
+
+    items = pd.DataFrame({
+        'customer_id': df['customer_id'],
+        'order_id': df['order_id'],
+        'order_date_plus_order_id': 'order_' + order_dates.dt.strftime('%Y-%m-%d') + '_' + df['order_id'],
+        'product_name': df['product_name'],
+        'order_date': df['order_date'],
+    })
+    return items.to_dict('records')
+
+
+def tokenize_product_name(product_name: str) -> List[str]:
+    return re.findall(r'[a-z0-9]+', product_name.lower())
+
+
+def prepare_token_items(items: List[Dict]) -> List[Dict]:
+    '''
+    The items of PRODUCT_TOKEN_TABLE_NAME for the order items of prepare_order_items().
+    '''
+    return [{
+        'customer_token': f'{item["customer_id"]}#{token}',
+        'order_date_plus_order_id': item['order_date_plus_order_id'],
+        'product_name': item['product_name'],
+        'order_date': item['order_date'],
+    } for item in items for token in dict.fromkeys(tokenize_product_name(item['product_name']))]
+
+
+def batch_write_items(client, items: List[Dict], table_name=TABLE_NAME, max_attempts=BATCH_WRITE_MAX_ATTEMPTS):
+    '''
+    Put up to BATCH_WRITE_SIZE items with one BatchWriteItem, resending the unprocessed ones with exponential backoff.
+    '''
+    serializer = TypeSerializer()
+    request_items = {table_name: [
+        {'PutRequest': {'Item': {name: serializer.serialize(value) for name, value in item.items()}}}
+        for item in items
+    ]}
+    for attempt in range(max_attempts):
+        resp = client.batch_write_item(RequestItems=request_items)
+        request_items = resp.get('UnprocessedItems')
+        if not request_items:
+            return
+        time.sleep(BATCH_WRITE_BACKOFF_S * 2 ** attempt * random.uniform(0.5, 1))
+
+    raise RuntimeError(f'{len(request_items[table_name])} items still unprocessed after {max_attempts} attempts')
+
+
+def bulk_write_table(df: Optional[pd.DataFrame] = None, num_writers=BULK_WRITERS,
+                     write_tokens=WRITE_PRODUCT_TOKENS) -> int:
+    '''
+    The same records as batch_write_table(), prepared column-wise and written by num_writers parallel writers.
+    '''
+    start = time.perf_counter()
+    if df is None:
+        df = pd.read_csv(CSV_FILE_LOCATION, dtype=str, keep_default_na=False)
+    items = prepare_order_items(df)
+    token_items = prepare_token_items(items) if write_tokens else []
+    prepared = time.perf_counter()
+
+    # boto3 clients are thread safe, resources (and their batch_writer) are not
+    client = ddb.meta.client
+    batches = [(items[i:i + BATCH_WRITE_SIZE], TABLE_NAME) for i in range(0, len(items), BATCH_WRITE_SIZE)]
+    batches += [(token_items[i:i + BATCH_WRITE_SIZE], PRODUCT_TOKEN_TABLE_NAME)
+                for i in range(0, len(token_items), BATCH_WRITE_SIZE)]
+    with ThreadPoolExecutor(max_workers=num_writers) as executor:
+        # list() re-raises the first error of the writers
+        list(executor.map(lambda batch: batch_write_items(client, *batch), batches))
+
+    elapsed = time.perf_counter() - start
+    logging.info(f'Completed writing records; total record: {df.shape[0]}; written orders: {len(items)}; '
+                 f'written product tokens: {len(token_items)}; {len(items) / elapsed:.0f} rows/sec ({prepared - start:.2f}s preparing, {num_writers} writers)')
+    return len(items)
+
+
+def create_order_item(customer_id, order_id, product_name, order_date):
+    parsed_order_date = parse_order_date(order_date)
+    if parsed_order_date is None:
         logging.warning(f'Invalid order_date string "{order_date}" for order {order_id}')
         return None
+    order_date_formatted_str = parsed_order_date.strftime("%Y-%m-%d")
 
     order_date_plus_order_id = f'order_{order_date_formatted_str}_{order_id}'
     return {
@@ -127,36 +342,357 @@ def create_order_item(customer_id, order_id, product_name, order_date):
     }
 
 
-def get_customer_orders(customer_id: str,
-                        product_name_substr: Optional[str] =None,
-                        start_date: Optional[datetime] = None,
-                        end_date: Optional[datetime] = None):
-    from boto3.dynamodb.conditions import Key, Attr
-
-    KeyConditionExpression = Key("customer_id").eq(customer_id)
-
-    # construct range date date filtering on sort key
+def get_order_date_condition(condition_type, start_date: Optional[datetime] = None,
+                             end_date: Optional[datetime] = None):
+    '''
+    The date range condition on order_date_plus_order_id, or None without dates; condition_type is Key for a key
+    condition, or Attr for a filter when order_date_plus_order_id is not the sort key of the query.
+    '''
     start_date_str = start_date.strftime("%Y-%m-%d") if start_date else None
     end_date_str = end_date.strftime("%Y-%m-%d") if end_date else None
     if start_date_str and end_date_str:
-        KeyConditionExpression = KeyConditionExpression & \
-            Key("order_date_plus_order_id").between(f'order_{start_date_str}', f'order_{end_date_str}')
+        return condition_type("order_date_plus_order_id").between(f'order_{start_date_str}', f'order_{end_date_str}')
     elif start_date_str:
-        KeyConditionExpression = KeyConditionExpression & Key("order_date_plus_order_id").gte(f'order_{start_date_str}')
+        return condition_type("order_date_plus_order_id").gte(f'order_{start_date_str}')
     elif end_date_str:
-        KeyConditionExpression = KeyConditionExpression & Key("order_date_plus_order_id").lte(f'order_{end_date_str}')
+        return condition_type("order_date_plus_order_id").lte(f'order_{end_date_str}')
+    return None
 
-    result = get_table().query(
-        KeyConditionExpression=KeyConditionExpression,
-        FilterExpression=Attr("product_name").contains(product_name_substr if product_name_substr else ''),
-        ProjectionExpression='order_date_plus_order_id, product_name, order_date',
-    )
-    
-    for order in result['Items']:
-        logging.info(f' - order: {order}')
+
+def get_order_key_condition(customer_id: str,
+                            start_date: Optional[datetime] = None,
+                            end_date: Optional[datetime] = None):
+    KeyConditionExpression = Key("customer_id").eq(customer_id)
+
+    # construct range date date filtering on sort key
+    date_condition = get_order_date_condition(Key, start_date, end_date)
+    if date_condition is not None:
+        KeyConditionExpression = KeyConditionExpression & date_condition
+    return KeyConditionExpression
+
+
+def query_customer_order_pages(customer_id: str,
+                               product_name_substr: Optional[str] = None,
+                               start_date: Optional[datetime] = None,
+                               end_date: Optional[datetime] = None,
+                               page_size: Optional[int] = None,
+                               projection: str = ORDER_PROJECTION,
+                               product_name_prefix: Optional[str] = None,
+                               table=None) -> Iterator[Dict]:
+    '''
+    Yield the query responses of the orders of a customer one page at a time, following LastEvaluatedKey; the next
+    page is only read when asked for. Every response has the Items, Count, ScannedCount and ConsumedCapacity.
+
+    With product_name_prefix, the query reads the PRODUCT_NAME_INDEX range of the product names starting with it
+    (in product name order), and the dates become a filter instead. table defaults to get_table().
+    '''
+    table = table or get_table()
+    filters = []
+    if product_name_prefix:
+        query_args = {
+            'IndexName': PRODUCT_NAME_INDEX,
+            'KeyConditionExpression': Key("customer_id").eq(customer_id) & \
+                Key("product_name").begins_with(product_name_prefix),
+        }
+        date_condition = get_order_date_condition(Attr, start_date, end_date)
+        if date_condition is not None:
+            filters.append(date_condition)
+    else:
+        query_args = {'KeyConditionExpression': get_order_key_condition(customer_id, start_date, end_date)}
+    query_args['ProjectionExpression'] = projection
+    query_args['ReturnConsumedCapacity'] = 'TOTAL'
+
+    # a filter is applied after the items are read, so it only costs when there is something to filter on
+    if product_name_substr:
+        filters.append(Attr("product_name").contains(product_name_substr))
+    if filters:
+        FilterExpression = filters[0]
+        for condition in filters[1:]:
+            FilterExpression = FilterExpression & condition
+        query_args['FilterExpression'] = FilterExpression
+    if page_size:
+        query_args['Limit'] = page_size
+
+    while True:
+        page = table.query(**query_args)
+        yield page
+        if 'LastEvaluatedKey' not in page:
+            return
+        query_args['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def query_customer_orders(customer_id: str,
+                          product_name_substr: Optional[str] = None,
+                          start_date: Optional[datetime] = None,
+                          end_date: Optional[datetime] = None,
+                          limit: Optional[int] = None,
+                          page_size: Optional[int] = None,
+                          projection: str = ORDER_PROJECTION,
+                          product_name_prefix: Optional[str] = None,
+                          table=None) -> Iterator[Dict]:
+    '''
+    Yield the orders of a customer, in order date order (product name order with product_name_prefix), stopping
+    after limit orders.
+    '''
+    if limit is not None and limit <= 0:
+        return
+    # without a filter every item read is returned, so there is no point in reading more than limit of them
+    has_filter = product_name_substr or (product_name_prefix and (start_date or end_date))
+    if limit and not has_filter and not page_size:
+        page_size = limit
+
+    num_orders = 0
+    for page in query_customer_order_pages(customer_id, product_name_substr, start_date, end_date, page_size,
+                                           projection, product_name_prefix, table):
+        for order in page['Items']:
+            yield order
+            num_orders += 1
+            if num_orders == limit:
+                return
+
+
+def query_product_token_pages(customer_id: str, token: str,
+                              start_date: Optional[datetime] = None,
+                              end_date: Optional[datetime] = None) -> Iterator[Dict]:
+    '''
+    Like query_customer_order_pages(), over the orders of a customer with token in the product name, from
+    PRODUCT_TOKEN_TABLE_NAME.
+    '''
+    KeyConditionExpression = Key("customer_token").eq(f'{customer_id}#{token}')
+    date_condition = get_order_date_condition(Key, start_date, end_date)
+    if date_condition is not None:
+        KeyConditionExpression = KeyConditionExpression & date_condition
+    query_args = {
+        'KeyConditionExpression': KeyConditionExpression,
+        'ProjectionExpression': ORDER_PROJECTION,
+        'ReturnConsumedCapacity': 'TOTAL',
+    }
+
+    token_table_obj = ddb.Table(PRODUCT_TOKEN_TABLE_NAME)
+    while True:
+        page = token_table_obj.query(**query_args)
+        yield page
+        if 'LastEvaluatedKey' not in page:
+            return
+        query_args['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def query_customer_orders_by_words(customer_id: str, words: List[str],
+                                   start_date: Optional[datetime] = None,
+                                   end_date: Optional[datetime] = None) -> Iterator[Dict]:
+    '''
+    Yield the orders of a customer whose product name has all the words (case insensitive), in order date order.
+    '''
+    tokens = list(dict.fromkeys(token for word in words for token in tokenize_product_name(word)))
+    if not tokens:
+        return
+
+    # the orders of the other tokens only need their keys
+    other_keys = [set(order['order_date_plus_order_id']
+                      for page in query_product_token_pages(customer_id, token, start_date, end_date)
+                      for order in page['Items'])
+                  for token in tokens[1:]]
+    for page in query_product_token_pages(customer_id, tokens[0], start_date, end_date):
+        for order in page['Items']:
+            if all(order['order_date_plus_order_id'] in keys for keys in other_keys):
+                yield order
+
+
+def query_customers_orders(customer_ids: List[str],
+                           filters: Optional[List[Dict]] = None,
+                           max_workers=CUSTOMER_QUERY_WORKERS,
+                           latencies: Optional[Dict[str, float]] = None) -> Iterator[Dict]:
+    '''
+    Yield the orders of many customers, customer by customer as their queries complete on max_workers threads.
+
+    filters are keyword arguments of query_customer_orders() (product_name_substr, start_date, end_date,
+    product_name_prefix, ...); every customer is queried with each of them, and an order matching several of them is
+    yielded once. The orders come with their customer_id. latencies, when given, gets the seconds the queries of
+    every customer took.
+
+    The threads belong to a long-lived executor per max_workers, so only the first calls pay for creating the boto3
+    session of every thread.
+    '''
+    filters = filters or [{}]
+
+    def query_customer(customer_id):
+        start = time.perf_counter()
+        orders = [order for filter_args in filters
+                  for order in query_customer_orders(customer_id, table=get_thread_table(), **filter_args)]
+        return customer_id, orders, time.perf_counter() - start
+
+    executor = get_customer_query_executor(max_workers)
+    futures = [executor.submit(query_customer, customer_id) for customer_id in dict.fromkeys(customer_ids)]
+    try:
+        for future in as_completed(futures):
+            customer_id, orders, elapsed = future.result()
+            if latencies is not None:
+                latencies[customer_id] = elapsed
+
+            seen = set()
+            for order in orders:
+                if order['order_date_plus_order_id'] not in seen:
+                    seen.add(order['order_date_plus_order_id'])
+                    yield {'customer_id': customer_id, **order}
+    finally:
+        # a consumer that stops early does not wait for the queries it will not read
+        for future in futures:
+            future.cancel()
+
+
+def log_latency_histogram(name: str, latencies: List[float]):
+    '''
+    Log latencies as a histogram of power of two millisecond buckets.
+    '''
+    latencies = sorted(latencies)
+    logging.info(f'{name}: {len(latencies)} customers, p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+                 f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms')
+    bucket_ms, i = 1, 0
+    while i < len(latencies):
+        count = 0
+        while i < len(latencies) and latencies[i] * 1000 <= bucket_ms:
+            count += 1
+            i += 1
+        if count:
+            logging.info(f'{name}: <= {bucket_ms:5} ms {count:5} {"#" * max(1, count * 50 // len(latencies))}')
+        bucket_ms *= 2
+
+
+def get_customer_orders(customer_id: str,
+                        product_name_substr: Optional[str] =None,
+                        start_date: Optional[datetime] = None,
+                        end_date: Optional[datetime] = None,
+                        product_name_prefix: Optional[str] = None):
+    for page in query_customer_order_pages(customer_id, product_name_substr, start_date, end_date,
+                                           product_name_prefix=product_name_prefix):
+        for order in page['Items']:
+            logging.info(f' - order: {order}')
+        read_units = page.get('ConsumedCapacity', {}).get('CapacityUnits')
+        logging.info(f' page: {page["Count"]} of {page["ScannedCount"]} read orders returned, {read_units} read units')
     logging.info('\n')
 
 
+def benchmark_bulk_write(scale=10):
+    '''
+    Rows per second of batch_write_table() against bulk_write_table(), over the CSV repeated scale times with distinct
+    order IDs.
+    '''
+    df = pd.read_csv(CSV_FILE_LOCATION, dtype=str, keep_default_na=False)
+    df = pd.concat([df.assign(order_id=df['order_id'] + f'_{i}') for i in range(scale)], ignore_index=True)
+
+    for name, write_table in (('iterrows + batch_writer', batch_write_table),
+                              (f'vectorized + {BULK_WRITERS} writers', bulk_write_table)):
+        delete_table()
+        create_table()
+        start = time.perf_counter()
+        num_written = write_table(df)
+        elapsed = time.perf_counter() - start
+        logging.info(f'BENCHMARK {name}: {num_written} rows in {elapsed:.2f}s, {num_written / elapsed:.0f} rows/sec')
+
+
+def sum_read_units(pages: Iterator[Dict]):
+    '''
+    Drain a page generator; returns the number of items and the read units consumed.
+    '''
+    num_items, read_units = 0, 0
+    for page in pages:
+        num_items += page['Count']
+        read_units += page.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+    return num_items, read_units
+
+
+def benchmark_product_search(num_customers=10, scale=5, num_words=20):
+    '''
+    Read units and latency of finding a customer's orders by product name: the contains() filter over all the orders
+    of the customer, the begins_with() query on PRODUCT_NAME_INDEX, and the word query on the token table. The CSV is
+    loaded scale times and spread over num_customers customers, so each has hundreds of orders; the search terms are
+    the first words of num_words random product names.
+    '''
+    df = pd.read_csv(CSV_FILE_LOCATION, dtype=str, keep_default_na=False)
+    df = pd.concat([df.assign(order_id=df['order_id'] + f'_{i}') for i in range(scale)], ignore_index=True)
+    df['customer_id'] = [f'C_ID_BENCH_{i % num_customers}' for i in range(len(df))]
+
+    delete_table()
+    create_table()
+    delete_table(PRODUCT_TOKEN_TABLE_NAME)
+    create_token_table()
+    bulk_write_table(df, write_tokens=True)
+
+    words = [name.split()[0] for name in df['product_name'].sample(n=num_words, random_state=1)]
+    paths = {
+        'contains() filter': lambda customer_id, word: query_customer_order_pages(customer_id, word),
+        'begins_with() on the LSI': lambda customer_id, word:
+            query_customer_order_pages(customer_id, product_name_prefix=word),
+        'token table': lambda customer_id, word:
+            query_product_token_pages(customer_id, tokenize_product_name(word)[0]),
+    }
+    for name, query_pages in paths.items():
+        num_found, read_units, latencies = 0, 0, []
+        for word in words:
+            if not tokenize_product_name(word):
+                continue
+            for i in range(num_customers):
+                start = time.perf_counter()
+                found, units = sum_read_units(query_pages(f'C_ID_BENCH_{i}', word))
+                latencies.append(time.perf_counter() - start)
+                num_found += found
+                read_units += units
+        latencies.sort()
+        logging.info(f'BENCHMARK {name}: {len(latencies)} searches, {num_found} orders found, '
+                     f'{read_units / len(latencies):.1f} read units/search, '
+                     f'p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+                     f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms')
+
+
+def benchmark_customer_fanout(num_customers=200, max_workers=CUSTOMER_QUERY_WORKERS):
+    '''
+    A dashboard of num_customers customers, each queried with two overlapping date ranges: one query after the other
+    on the shared table against query_customers_orders(), with the per-customer latency histograms of both.
+    '''
+    delete_table()
+    create_table()
+    bulk_write_table()
+
+    df = pd.read_csv(CSV_FILE_LOCATION, dtype=str, keep_default_na=False)
+    customer_ids = list(df['customer_id'].unique()[:num_customers])
+    filters = [{'start_date': datetime(year=2022, month=1, day=1)}, {'end_date': datetime(year=2022, month=6, day=30)}]
+
+    start = time.perf_counter()
+    sequential_latencies, num_orders = [], 0
+    for customer_id in customer_ids:
+        customer_start = time.perf_counter()
+        num_orders += len(set(order['order_date_plus_order_id'] for filter_args in filters
+                              for order in query_customer_orders(customer_id, **filter_args)))
+        sequential_latencies.append(time.perf_counter() - customer_start)
+    elapsed = time.perf_counter() - start
+    logging.info(f'BENCHMARK sequential: {num_orders} orders of {len(customer_ids)} customers in {elapsed:.2f}s')
+    log_latency_histogram('BENCHMARK sequential', sequential_latencies)
+
+    # a first round creates the sessions of the worker threads, which later dashboards reuse
+    for _ in query_customers_orders(customer_ids, filters, max_workers):
+        pass
+
+    start = time.perf_counter()
+    latencies = {}
+    num_orders = sum(1 for _ in query_customers_orders(customer_ids, filters, max_workers, latencies))
+    elapsed = time.perf_counter() - start
+    logging.info(f'BENCHMARK {max_workers} workers: {num_orders} orders of {len(customer_ids)} customers in '
+                 f'{elapsed:.2f}s')
+    log_latency_histogram(f'BENCHMARK {max_workers} workers', list(latencies.values()))
+
+
+BENCHMARKS = {
+    'bulk_write': benchmark_bulk_write,
+    'product_search': benchmark_product_search,
+    'customer_fanout': benchmark_customer_fanout,
+}
+
+
 if __name__ == "__main__":
-    main()
+    # python3 challenge_ecommerce.py benchmark [name ...]
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        for name in (sys.argv[2:] or BENCHMARKS.keys()):
+            BENCHMARKS[name]()
+    else:
+        main()
     
\ No newline at end of file
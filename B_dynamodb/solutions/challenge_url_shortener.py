@@ -1,17 +1,63 @@
-from typing import Optional
+from typing import Optional, List, Dict
 import os
+import sys
+import time
 import logging
 import random
 import base64
+import string
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 import boto3
 import botocore
+from boto3.dynamodb.types import TypeSerializer
 
 logging.basicConfig(level=logging.INFO)
 
 
 SHORT_TO_FULL_TABLE_NAME = 'short_to_full_url_table'
 FULL_TO_SHORT_TABLE_NAME = 'full_to_short_url_table'
+ID_COUNTER_TABLE_NAME = 'short_url_id_counter_table'
+
+# How encode_n_save_url() picks short URLs:
+# - 'random': base64 of a random number, probing up to 5 of them for one that is not taken, then two put_item()
+# - 'range': the base62 of the next ID of a block of ID_BLOCK_SIZE IDs leased from a counter item in
+#   ID_COUNTER_TABLE_NAME (one atomic UpdateItem ADD per block), both mappings written in one TransactWriteItems
+SHORT_URL_ALLOCATION = 'range'
+ID_BLOCK_SIZE = 1000
+BASE62_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+# encode_n_save_urls() checks BATCH_GET_SIZE full URLs per BatchGetItem and writes BATCH_WRITE_SIZE mappings per
+# BatchWriteItem (both the DynamoDB maximum), resending unprocessed keys and items up to BATCH_MAX_ATTEMPTS times
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+BATCH_MAX_ATTEMPTS = 8
+BATCH_BACKOFF_S = 0.05
+
+# With NORMALIZE_URLS, full URLs are normalized before they are looked up in FULL_TO_SHORT_TABLE_NAME (lower case
+# scheme and host, no default port, query parameters sorted by name, no fragment), so equivalent URLs share one short
+# URL; short URLs still redirect to the URL as it was first given. A URL which cannot be parsed is kept as it is.
+# FULL_URL_KEY is the hash key of FULL_TO_SHORT_TABLE_NAME:
+# - 'url': the (normalized) full URL itself, which can be kilobytes long
+# - 'digest': the first FULL_URL_DIGEST_BYTES bytes of its SHA-256, as a binary attribute
+NORMALIZE_URLS = True
+FULL_URL_KEY = 'digest'
+FULL_URL_DIGEST_BYTES = 16
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+URLS_FILE_LOCATION = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                  'data', 'urls.txt')
+
+# look_up_short_url() and look_up_long_url() read through an in-process LRUCache each, of at most URL_CACHE_SIZE
+# URLs kept for URL_CACHE_TTL_S. A URL that is not in the table is cached as a miss too, for the shorter
+# URL_NEGATIVE_CACHE_TTL_S, which is what the probes of encode_n_save_url() mostly look up; the mappings we write
+# replace those entries right away, the ones written by other processes show up after the negative TTL.
+URL_CACHE_SIZE = 10_000
+URL_CACHE_TTL_S = 300
+URL_NEGATIVE_CACHE_TTL_S = 5
 
 ddb = boto3.resource('dynamodb', endpoint_url='http://localhost:8000')
 short_to_full_table_obj = None
@@ -25,11 +71,7 @@ def main():
     create_tables()
 
     # Load URLs
-    urls = []
-    file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'urls.txt')
-    with open(file_path, 'r') as file:
-        urls = [line.rstrip() for line in file]
-    urls = list(filter(lambda x: x.startswith('http'), urls))
+    urls = load_urls()
 
     logging.info('Add URLs....')
     num_urls_to_shorten = 200
@@ -37,7 +79,8 @@ def main():
     full_to_short_url_map = {}
     for i in range(num_urls_to_shorten):
         short_url = encode_n_save_url(urls[i])
-        short_to_full_url_map[short_url] = urls[i]
+        # equivalent URLs share the short URL, which redirects to the first of them
+        short_to_full_url_map.setdefault(short_url, urls[i])
         full_to_short_url_map[urls[i]] = short_url
 
         if i % 20 == 0:
@@ -50,6 +93,15 @@ def main():
         if short_url != full_to_short_url_map[urls[i]]:
             logging.error(f"Short URL is created twice for the same full URL {urls[i]}")
     
+    # shorten the next URLs in bulk, with the first ones again which must keep their short URLs
+    logging.info('Add URLs in bulk....')
+    bulk_urls = urls[:10] + urls[num_urls_to_shorten:2 * num_urls_to_shorten]
+    for full_url, short_url in zip(bulk_urls, encode_n_save_urls(bulk_urls)):
+        if full_url in full_to_short_url_map and short_url != full_to_short_url_map[full_url]:
+            logging.error(f"Short URL is created twice for the same full URL {full_url}")
+        short_to_full_url_map.setdefault(short_url, full_url)
+        full_to_short_url_map[full_url] = short_url
+
     # Look up a few short URLs
     logging.info('Verify shortened URLs....')
     all_short_urls = list(short_to_full_url_map.keys())
@@ -61,9 +113,80 @@ def main():
         if full_url != full_url_from_db:
             logging.error(f"the short URL ({short_url}) lookup returns a different full URL: ({short_url}), ({full_url_from_db})")
 
+    logging.info(f'Short URL cache: {short_url_cache.stats()}')
+    logging.info(f'Long URL cache: {long_url_cache.stats()}')
     logging.info('MAIN process exiting...')
 
 
+def load_urls() -> List[str]:
+    with open(URLS_FILE_LOCATION, 'r') as file:
+        urls = [line.rstrip() for line in file]
+    return list(filter(lambda x: x.startswith('http'), urls))
+
+
+class LRUCache():
+    '''
+    A thread safe LRU cache whose entries expire after a TTL; None values are cached misses, which expire after
+    the shorter negative_ttl_s.
+
+    get() returns CACHE_MISS for a key that is not cached (or expired), and the cached value (maybe None) otherwise.
+    '''
+    def __init__(self, max_size=URL_CACHE_SIZE, ttl_s=URL_CACHE_TTL_S, negative_ttl_s=URL_NEGATIVE_CACHE_TTL_S):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.negative_ttl_s = negative_ttl_s
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> (value, expiry time.monotonic()); least recently used first
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return CACHE_MISS
+
+            self.entries.move_to_end(key)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        ttl_s = self.ttl_s if value is not None else self.negative_ttl_s
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl_s)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> str:
+        lookups = self.hits + self.negative_hits + self.misses
+        hit_ratio = (self.hits + self.negative_hits) / lookups if lookups else 0
+        return (f'{lookups} lookups, {hit_ratio:.1%} hit ratio ({self.negative_hits} negative hits), '
+                f'{self.evictions} evictions, {self.expirations} expirations, {len(self.entries)} entries')
+
+
+CACHE_MISS = object()
+short_url_cache = LRUCache()
+long_url_cache = LRUCache()
+
+
 def create_short_to_full_table():
     global short_to_full_table_obj
 
@@ -98,12 +221,20 @@ def create_full_to_short_table():
     except botocore.exceptions.ClientError:
         pass
 
-    AttributeDefinitions = [
-        { 'AttributeName': 'full_url', 'AttributeType': 'S'}
-    ]
-    KeySchema=[
-        {'AttributeName': 'full_url', 'KeyType': 'HASH'},
-    ]
+    if FULL_URL_KEY == 'digest':
+        AttributeDefinitions = [
+            { 'AttributeName': 'url_digest', 'AttributeType': 'B'}
+        ]
+        KeySchema=[
+            {'AttributeName': 'url_digest', 'KeyType': 'HASH'},
+        ]
+    else:
+        AttributeDefinitions = [
+            { 'AttributeName': 'full_url', 'AttributeType': 'S'}
+        ]
+        KeySchema=[
+            {'AttributeName': 'full_url', 'KeyType': 'HASH'},
+        ]
     ProvisionedThroughput = {'ReadCapacityUnits': 10, 'WriteCapacityUnits': 10}
 
     full_to_short_table_obj = ddb.create_table(
@@ -120,6 +251,187 @@ def create_tables():
     # Also, we need to specify ProvisionedThroughput even thoug we don't care here.
     create_short_to_full_table()
     create_full_to_short_table()
+    create_id_counter_table()
+    short_url_cache.clear()
+    long_url_cache.clear()
+    short_url_id_allocator.reset()
+
+
+def create_id_counter_table():
+    id_counter_table_obj = ddb.Table(ID_COUNTER_TABLE_NAME)
+    try:
+        id_counter_table_obj.delete()
+    except botocore.exceptions.ClientError:
+        pass
+
+    AttributeDefinitions = [
+        { 'AttributeName': 'counter_name', 'AttributeType': 'S'}
+    ]
+    KeySchema=[
+        {'AttributeName': 'counter_name', 'KeyType': 'HASH'},
+    ]
+    ProvisionedThroughput = {'ReadCapacityUnits': 10, 'WriteCapacityUnits': 10}
+
+    id_counter_table_obj = ddb.create_table(
+        TableName=ID_COUNTER_TABLE_NAME,
+        AttributeDefinitions=AttributeDefinitions,
+        KeySchema=KeySchema,
+        ProvisionedThroughput=ProvisionedThroughput)
+    id_counter_table_obj.wait_until_exists()
+
+
+def get_short_to_full_table():
+    global short_to_full_table_obj
+    if short_to_full_table_obj is None:
+        short_to_full_table_obj = ddb.Table(SHORT_TO_FULL_TABLE_NAME)
+    return short_to_full_table_obj
+
+
+def get_full_to_short_table():
+    global full_to_short_table_obj
+    if full_to_short_table_obj is None:
+        full_to_short_table_obj = ddb.Table(FULL_TO_SHORT_TABLE_NAME)
+    return full_to_short_table_obj
+
+
+def base62_encode(number: int) -> str:
+    digits = []
+    while True:
+        number, digit = divmod(number, 62)
+        digits.append(BASE62_ALPHABET[digit])
+        if number == 0:
+            return ''.join(reversed(digits))
+
+
+def base62_decode(encoded: str) -> int:
+    number = 0
+    for char in encoded:
+        number = number * 62 + BASE62_ALPHABET.index(char)
+    return number
+
+
+class ShortUrlIdAllocator():
+    '''
+    Hands out unique IDs for short URLs from blocks leased from the counter item of ID_COUNTER_TABLE_NAME.
+
+    Every lease is one atomic UpdateItem ADD of block_size to the counter, so processes never get the same ID and
+    need no read before writing; the IDs left in the block of a process that exits are skipped.
+    '''
+    def __init__(self, block_size=ID_BLOCK_SIZE, counter_name='short_url'):
+        self.block_size = block_size
+        self.counter_name = counter_name
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.end_id = 0     # the block is next_id..end_id - 1
+        self.leases = 0
+
+    def lease_block(self):
+        resp = ddb.Table(ID_COUNTER_TABLE_NAME).update_item(
+            Key={'counter_name': self.counter_name},
+            UpdateExpression='ADD next_id :block_size',
+            ExpressionAttributeValues={':block_size': self.block_size},
+            ReturnValues='UPDATED_NEW')
+        self.end_id = int(resp['Attributes']['next_id'])
+        self.next_id = self.end_id - self.block_size
+        self.leases += 1
+
+    def next(self) -> int:
+        with self.lock:
+            if self.next_id >= self.end_id:
+                self.lease_block()
+            self.next_id += 1
+            return self.next_id - 1
+
+    def reset(self):
+        with self.lock:
+            self.next_id = self.end_id = 0
+            self.leases = 0
+
+
+short_url_id_allocator = ShortUrlIdAllocator()
+
+
+def normalize_url(full_url: str) -> str:
+    try:
+        parts = urlsplit(full_url.strip())
+        port = parts.port
+    except ValueError:
+        # an invalid port or IPv6 address; such a URL is only known by its exact spelling
+        return full_url
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if ':' in netloc:
+        # IPv6 address
+        netloc = f'[{netloc}]'
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = f'{netloc}:{port}'
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else f'{parts.username}:{parts.password}'
+        netloc = f'{userinfo}@{netloc}'
+    path = parts.path or '/'
+    # the sort is stable and on the name only: the values of a repeated parameter keep their order, which matters
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True), key=lambda pair: pair[0]))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def get_lookup_url(full_url: str) -> str:
+    '''
+    The form of full_url that FULL_TO_SHORT_TABLE_NAME and long_url_cache know it by.
+    '''
+    return normalize_url(full_url) if NORMALIZE_URLS else full_url
+
+
+def get_full_to_short_key(lookup_url: str) -> Dict:
+    if FULL_URL_KEY == 'digest':
+        return {'url_digest': hashlib.sha256(lookup_url.encode('utf-8')).digest()[:FULL_URL_DIGEST_BYTES]}
+    return {'full_url': lookup_url}
+
+
+def get_full_to_short_item(lookup_url: str, short_url: str) -> Dict:
+    # the URL itself stays in the item, so a lookup can tell a digest collision from a match
+    return {**get_full_to_short_key(lookup_url), 'full_url': lookup_url, 'short_url': short_url}
+
+
+def save_url_with_allocated_id(full_url: str, max_attempts=3) -> Optional[str]:
+    '''
+    Map full_url to the base62 of a newly allocated ID, writing both mappings in one transaction that fails when
+    either key exists; returns the short URL of full_url, which another process may have saved first.
+    '''
+    lookup_url = get_lookup_url(full_url)
+    serializer = TypeSerializer()
+    for attempt in range(max_attempts):
+        short_url = base62_encode(short_url_id_allocator.next())
+        full_to_short_item = get_full_to_short_item(lookup_url, short_url)
+        try:
+            ddb.meta.client.transact_write_items(TransactItems=[
+                {'Put': {
+                    'TableName': SHORT_TO_FULL_TABLE_NAME,
+                    'Item': {'short_url': {'S': short_url}, 'full_url': {'S': full_url}},
+                    'ConditionExpression': 'attribute_not_exists(short_url)',
+                }},
+                {'Put': {
+                    'TableName': FULL_TO_SHORT_TABLE_NAME,
+                    'Item': {name: serializer.serialize(value) for name, value in full_to_short_item.items()},
+                    'ConditionExpression': 'attribute_not_exists(full_url)',
+                }},
+            ])
+        except ddb.meta.client.exceptions.TransactionCanceledException as e:
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            if len(reasons) > 1 and reasons[1] == 'ConditionalCheckFailed':
+                # the full URL was saved since we looked it up
+                return look_up_long_url(full_url, use_cache=False)
+            if reasons and reasons[0] == 'ConditionalCheckFailed':
+                # only when the counter went back (the tables were recreated); take the next ID
+                logging.warning(f'Short URL {short_url} is taken already')
+                continue
+            raise
+
+        short_url_cache.put(short_url, full_url)
+        long_url_cache.put(lookup_url, short_url)
+        return short_url
+
+    logging.info('Unable to find a new available short URL')
+    return None
 
 
 def encode_n_save_url(full_url: str) -> str:
@@ -128,6 +440,9 @@ def encode_n_save_url(full_url: str) -> str:
     if short_url:
         return short_url
 
+    if SHORT_URL_ALLOCATION == 'range':
+        return save_url_with_allocated_id(full_url)
+
     # Look for a unused short URL
     encoded_short_url = None
     for i in range(5):
@@ -145,30 +460,269 @@ def encode_n_save_url(full_url: str) -> str:
         logging.info('Unable to find a new available short URL')
         return None
     
-    short_to_full_table_obj.put_item(Item={'short_url': encoded_short_url, 'full_url': full_url})
-    full_to_short_table_obj.put_item(Item={'full_url': full_url, 'short_url': encoded_short_url})
+    lookup_url = get_lookup_url(full_url)
+    get_short_to_full_table().put_item(Item={'short_url': encoded_short_url, 'full_url': full_url})
+    get_full_to_short_table().put_item(Item=get_full_to_short_item(lookup_url, encoded_short_url))
+    # replaces the negative entries of the lookups above
+    short_url_cache.put(encoded_short_url, full_url)
+    long_url_cache.put(lookup_url, encoded_short_url)
     return encoded_short_url
 
 
-def look_up_short_url(short_url: str) -> Optional[str]:
-    short_to_full_table_obj = ddb.Table(SHORT_TO_FULL_TABLE_NAME)
-    resp = short_to_full_table_obj.get_item(Key={'short_url': short_url})
-
-    if 'Item' not in resp:
-        return None
+def batch_get_short_urls(lookup_urls: List[str]) -> Dict[str, str]:
+    '''
+    The short URLs saved for lookup_urls (distinct get_lookup_url() forms), with BatchGetItem of BATCH_GET_SIZE keys.
+    '''
+    short_urls = {}
+    for i in range(0, len(lookup_urls), BATCH_GET_SIZE):
+        request_items = {FULL_TO_SHORT_TABLE_NAME: {
+            'Keys': [get_full_to_short_key(lookup_url) for lookup_url in lookup_urls[i:i + BATCH_GET_SIZE]],
+            'ProjectionExpression': 'full_url, short_url',
+        }}
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            resp = ddb.batch_get_item(RequestItems=request_items)
+            for item in resp['Responses'].get(FULL_TO_SHORT_TABLE_NAME, []):
+                short_urls[item['full_url']] = item['short_url']
+            request_items = resp.get('UnprocessedKeys')
+            if not request_items:
+                break
+            time.sleep(BATCH_BACKOFF_S * 2 ** attempt * random.uniform(0.5, 1))
+        else:
+            raise RuntimeError(f'Full URLs still unprocessed after {BATCH_MAX_ATTEMPTS} attempts')
+    return short_urls
+
+
+def batch_put_items(table_name: str, items: List[Dict]):
+    '''
+    Put items into table_name with BatchWriteItem of BATCH_WRITE_SIZE items.
+    '''
+    for i in range(0, len(items), BATCH_WRITE_SIZE):
+        request_items = {table_name: [{'PutRequest': {'Item': item}} for item in items[i:i + BATCH_WRITE_SIZE]]}
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            request_items = ddb.batch_write_item(RequestItems=request_items).get('UnprocessedItems')
+            if not request_items:
+                break
+            time.sleep(BATCH_BACKOFF_S * 2 ** attempt * random.uniform(0.5, 1))
+        else:
+            raise RuntimeError(f'Items still unprocessed after {BATCH_MAX_ATTEMPTS} attempts')
+
+
+def encode_n_save_urls(full_urls: List[str]) -> List[str]:
+    '''
+    Bulk version of encode_n_save_url(): returns the short URL of every full URL.
+
+    The full URLs that are not in the cache are checked with BatchGetItem, and the new ones get IDs of
+    short_url_id_allocator (whatever SHORT_URL_ALLOCATION is; probing does not batch). The mappings are written with
+    BatchWriteItem, short to full first, so a short URL never shows up before it resolves. Batch writes cannot be
+    conditional: a new URL shortened by another process at the same time ends up with two short URLs that both
+    resolve, and full_to_short keeps the last one written.
+    '''
+    lookup_urls = [get_lookup_url(full_url) for full_url in full_urls]
+    # the first of the full URLs of every lookup URL is the one its new short URL redirects to
+    first_full_urls = {}
+    for full_url, lookup_url in zip(full_urls, lookup_urls):
+        first_full_urls.setdefault(lookup_url, full_url)
+
+    short_urls = {}
+    unknown_urls = []
+    for lookup_url in first_full_urls:
+        cached = long_url_cache.get(lookup_url)
+        # a cached miss may be stale; check those again too
+        if cached is not CACHE_MISS and cached is not None:
+            short_urls[lookup_url] = cached
+        else:
+            unknown_urls.append(lookup_url)
+
+    saved = batch_get_short_urls(unknown_urls)
+    new_urls = [lookup_url for lookup_url in unknown_urls if lookup_url not in saved]
+    new_short_urls = {lookup_url: base62_encode(short_url_id_allocator.next()) for lookup_url in new_urls}
+
+    batch_put_items(SHORT_TO_FULL_TABLE_NAME,
+                    [{'short_url': short_url, 'full_url': first_full_urls[lookup_url]}
+                     for lookup_url, short_url in new_short_urls.items()])
+    batch_put_items(FULL_TO_SHORT_TABLE_NAME,
+                    [get_full_to_short_item(lookup_url, short_url) for lookup_url, short_url in new_short_urls.items()])
+
+    for lookup_url, short_url in saved.items():
+        short_urls[lookup_url] = short_url
+        long_url_cache.put(lookup_url, short_url)
+    for lookup_url, short_url in new_short_urls.items():
+        short_urls[lookup_url] = short_url
+        long_url_cache.put(lookup_url, short_url)
+        short_url_cache.put(short_url, first_full_urls[lookup_url])
+    return [short_urls[lookup_url] for lookup_url in lookup_urls]
+
+
+def look_up_short_url(short_url: str, use_cache: bool = True) -> Optional[str]:
+    if use_cache:
+        cached = short_url_cache.get(short_url)
+        if cached is not CACHE_MISS:
+            return cached
+
+    resp = get_short_to_full_table().get_item(Key={'short_url': short_url})
+    full_url = resp['Item']['full_url'] if 'Item' in resp else None
     
-    return resp['Item']['full_url']
+    if use_cache:
+        short_url_cache.put(short_url, full_url)
+    return full_url
+
+
+def look_up_long_url(full_url: str, use_cache: bool = True) -> Optional[str]:
+    lookup_url = get_lookup_url(full_url)
+    if use_cache:
+        cached = long_url_cache.get(lookup_url)
+        if cached is not CACHE_MISS:
+            return cached
+
+    resp = get_full_to_short_table().get_item(Key=get_full_to_short_key(lookup_url))
+    short_url = None
+    if 'Item' in resp:
+        if resp['Item']['full_url'] == lookup_url:
+            short_url = resp['Item']['short_url']
+        else:
+            logging.error(f'URL digest collision of {lookup_url} and {resp["Item"]["full_url"]}')
 
+    if use_cache:
+        long_url_cache.put(lookup_url, short_url)
+    return short_url
 
-def look_up_long_url(full_url: str) -> Optional[str]:
-    # Ideally we should normalize URL before lookup; however, to keep things simple, skip normalization
-    full_to_short_table_obj = ddb.Table(FULL_TO_SHORT_TABLE_NAME)
-    resp = full_to_short_table_obj.get_item(Key={'full_url': full_url})
 
-    if 'Item' not in resp:
-        return None
-    return resp['Item']['short_url']
+def benchmark_lookup_cache(num_lookups=20_000, zipf_s=1.1, cache_sizes=(100, 1000)):
+    '''
+    Redirect traffic: look_up_short_url() of the short URLs of data/urls.txt, picked with a Zipf distribution of
+    exponent zipf_s, without the cache and with caches of cache_sizes URLs.
+    '''
+    create_tables()
+    short_urls = [encode_n_save_url(url) for url in load_urls()]
+    short_urls = [short_url for short_url in short_urls if short_url]
+
+    random.seed(1)
+    weights = [1 / rank ** zipf_s for rank in range(1, len(short_urls) + 1)]
+    lookups = random.choices(short_urls, weights=weights, k=num_lookups)
+
+    global short_url_cache
+    cache = short_url_cache
+    try:
+        for cache_size in (None,) + tuple(cache_sizes):
+            short_url_cache = LRUCache(max_size=cache_size or 1)
+            start = time.perf_counter()
+            for short_url in lookups:
+                look_up_short_url(short_url, use_cache=cache_size is not None)
+            elapsed = time.perf_counter() - start
+            name = f'cache of {cache_size}' if cache_size else 'no cache'
+            logging.info(f'BENCHMARK {name}: {num_lookups / elapsed:.0f} lookups/sec'
+                         + (f', {short_url_cache.stats()}' if cache_size else ''))
+    finally:
+        short_url_cache = cache
+
+
+def benchmark_shorten(num_urls=500):
+    '''
+    URLs shortened per second by encode_n_save_url() with random short URLs and probing, against IDs from leased
+    blocks and one transaction per URL.
+    '''
+    global SHORT_URL_ALLOCATION
+    urls = load_urls()[:num_urls]
+    allocation = SHORT_URL_ALLOCATION
+
+    try:
+        for SHORT_URL_ALLOCATION in ('random', 'range'):
+            create_tables()
+            start = time.perf_counter()
+            short_urls = [encode_n_save_url(url) for url in urls]
+            elapsed = time.perf_counter() - start
+            logging.info(f'BENCHMARK {SHORT_URL_ALLOCATION}: {len(urls) / elapsed:.0f} URLs/sec, '
+                         f'{len(set(short_urls))} distinct short URLs for {len(set(urls))} URLs, '
+                         f'{short_url_id_allocator.leases} ID blocks leased')
+    finally:
+        SHORT_URL_ALLOCATION = allocation
+
+
+def benchmark_bulk_shorten():
+    '''
+    URLs shortened per second from data/urls.txt, one encode_n_save_url() at a time against encode_n_save_urls().
+    '''
+    urls = load_urls()
+
+    for name, shorten in (('single', lambda urls: [encode_n_save_url(url) for url in urls]),
+                          ('bulk', encode_n_save_urls)):
+        create_tables()
+        start = time.perf_counter()
+        short_urls = shorten(urls)
+        elapsed = time.perf_counter() - start
+        logging.info(f'BENCHMARK {name}: {len(urls) / elapsed:.0f} URLs/sec, '
+                     f'{len(set(short_urls))} distinct short URLs for {len(set(urls))} URLs')
+
+
+def estimate_item_size(item: Dict) -> int:
+    # what DynamoDB bills: the attribute names plus the values, strings in UTF-8
+    return sum(len(name.encode('utf-8')) + (len(value) if isinstance(value, bytes) else len(str(value).encode('utf-8')))
+               for name, value in item.items())
+
+
+def make_url_variant(full_url: str) -> str:
+    '''
+    An equivalent spelling of full_url: upper case scheme and host, explicit default port, query parameters in reverse
+    name order (the values of a repeated name keep theirs) and a fragment.
+    '''
+    parts = urlsplit(full_url)
+    netloc = parts.netloc.upper()
+    if parts.port is None and parts.scheme.lower() in DEFAULT_PORTS:
+        netloc = f'{netloc}:{DEFAULT_PORTS[parts.scheme.lower()]}'
+    params = sorted(parts.query.split('&'), key=lambda param: param.split('=')[0], reverse=True)
+    query = '&'.join(params) if parts.query else ''
+    return urlunsplit((parts.scheme.upper(), netloc, parts.path, query, 'top'))
+
+
+def benchmark_url_keys(num_lookups=2000, num_variants=200):
+    '''
+    FULL_TO_SHORT_TABLE_NAME keyed on the raw URL, on the normalized URL and on the digest of the normalized URL:
+    key and item bytes of the URLs of data/urls.txt, latency of uncached look_up_long_url(), and how many spelling
+    variants of the URLs are found under the short URL of the original.
+    '''
+    global NORMALIZE_URLS, FULL_URL_KEY
+    settings = (NORMALIZE_URLS, FULL_URL_KEY)
+    urls = load_urls()
+    random.seed(1)
+    lookups = random.choices(urls, k=num_lookups)
+    variants = [(url, make_url_variant(url)) for url in random.sample(urls, num_variants)]
+
+    try:
+        for NORMALIZE_URLS, FULL_URL_KEY in ((False, 'url'), (True, 'url'), (True, 'digest')):
+            create_tables()
+            short_urls = dict(zip(urls, encode_n_save_urls(urls)))
+            items = [get_full_to_short_item(get_lookup_url(url), short_url) for url, short_url in short_urls.items()]
+            key_bytes = sum(estimate_item_size(get_full_to_short_key(item['full_url'])) for item in items)
+            item_bytes = sum(estimate_item_size(item) for item in items)
+            table_bytes = ddb.meta.client.describe_table(TableName=FULL_TO_SHORT_TABLE_NAME)['Table']['TableSizeBytes']
+
+            start = time.perf_counter()
+            for url in lookups:
+                look_up_long_url(url, use_cache=False)
+            latency = (time.perf_counter() - start) / num_lookups
+
+            num_found = sum(1 for url, variant in variants
+                            if look_up_long_url(variant, use_cache=False) == short_urls[url])
+            name = f'{"normalized" if NORMALIZE_URLS else "raw"} URL{" digest" if FULL_URL_KEY == "digest" else ""}'
+            logging.info(f'BENCHMARK {name}: {len(items)} items, {key_bytes / len(items):.0f} key bytes/item, '
+                         f'{item_bytes / len(items):.0f} item bytes/item, TableSizeBytes {table_bytes}, '
+                         f'lookup {latency * 1000:.2f} ms, {num_found} of {num_variants} URL variants found')
+    finally:
+        NORMALIZE_URLS, FULL_URL_KEY = settings
+
+
+BENCHMARKS = {
+    'lookup_cache': benchmark_lookup_cache,
+    'shorten': benchmark_shorten,
+    'bulk_shorten': benchmark_bulk_shorten,
+    'url_keys': benchmark_url_keys,
+}
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # python3 challenge_url_shortener.py benchmark [name ...]
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        for name in (sys.argv[2:] or BENCHMARKS.keys()):
+            BENCHMARKS[name]()
+    else:
+        main()
\ No newline at end of file